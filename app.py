@@ -1,19 +1,183 @@
-from flask import Flask, request, abort, jsonify
+import json
+import os
+
+from flask import Flask, request, abort, jsonify, Response, \
+    stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from database.models import db_drop_and_create_all, setup_db, Actor, Movie
-from auth.auth import AuthError, requires_auth
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm.exc import StaleDataError
+from database.models import db_drop_and_create_all, setup_db, db, Actor, \
+    Movie, projection_options
+from database.changes import changes
+from database.name_index import actor_names
+from database.query_log import query_log
+from database.cast import CastError, resolve_cast
+from database.sync import new_sync_token, decode_sync_token, is_expired, \
+    changed_since, deleted_since
+from auth.auth import AuthError, requires_auth, check_permissions
+from middleware.access_log import access_log
+from middleware.compression import compression
+from middleware.coalescing import coalesce, single_flight
+from middleware.idempotency import idempotent
+from middleware.caching import cache_policy, surrogate_keys, tag_records
+from database.snapshot import SnapshotError, write_snapshot
+from database.outbox import task_queue
+from database.documents import fetch_document
+from database.statements import load_one, load_many, load_all
+from database.dates import parse_date
+
+# seconds between keep-alive comments on an idle change stream
+CHANGES_KEEPALIVE = 15
+
+# maximum number of ids accepted by a multi-get request
+MAX_IDS = 50
+
+# directory the snapshots taken through POST /admin/snapshots are written to
+SNAPSHOT_DIR = os.environ.get("SNAPSHOT_DIR", "snapshots")
+
+
+def format_event(event):
+    """formats a change event as a Server-Sent Events message"""
+    return "id: {}\ndata: {}\n\n".format(event["id"], json.dumps(event))
+
+
+def require_permission(permission, payload):
+    """aborts unless the already verified JWT payload has the permission"""
+    try:
+        check_permissions(permission, payload)
+    except AuthError as authError:
+        abort(authError.status_code, authError.error["description"])
+
+
+def get_requested_ids():
+    """
+    parses the comma separated ids query parameter of the list endpoints
+    returns None when it is absent, aborts when it is malformed
+    """
+    ids = request.args.get("ids")
+    if ids is None:
+        return None
+
+    try:
+        requested_ids = list(dict.fromkeys(
+            int(value) for value in ids.split(",")))
+    except ValueError:
+        abort(400, "ids must be a comma separated list of integers.")
+
+    if len(requested_ids) > MAX_IDS:
+        abort(400, "At most {} ids can be requested at once.".format(MAX_IDS))
+
+    return requested_ids
+
+
+def get_projection(model, default_fields, default_include):
+    """
+    parses the fields and include query parameters of the read endpoints
+    returns the columns to load and whether to load the relationship
+    """
+    fields = request.args.get("fields")
+    include = request.args.get("include")
+
+    if not fields and include is None:
+        return default_fields, default_include
+
+    fields = fields.split(",") if fields else default_fields
+    if not set(fields) <= set(model.FIELDS):
+        abort(400, "fields must be a comma separated list of {}.".format(
+            ", ".join(model.FIELDS)))
+
+    if include not in (None, model.RELATIONSHIP):
+        abort(400, "include only accepts {}.".format(model.RELATIONSHIP))
+
+    return fields, include is not None
+
+
+def document_response(entity, entity_id):
+    """
+    returns the pre-encoded response of a detail route requested without
+    fields or include parameters, None while its document is regenerated
+    """
+    if request.args.get("fields") or "include" in request.args:
+        return None
+
+    document = fetch_document(entity, entity_id)
+    if document is None:
+        return None
+
+    return versioned(Response(document.body, mimetype="application/json"),
+                     document.version)
+
+
+def check_if_match(version):
+    """aborts with 412 if the If-Match header doesn't match the version"""
+    if request.if_match and not request.if_match.contains(str(version)):
+        abort(412, "The resource was modified, fetch it again.")
+
+
+def versioned(response, version):
+    """sets the ETag used for optimistic concurrency control"""
+    response.set_etag(str(version))
+    return response
+
+
+def get_updated_since():
+    """
+    parses the updated_since query parameter of the list endpoints
+    returns None when it is absent, aborts when it can't be served
+    """
+    token = request.args.get("updated_since")
+    if token is None:
+        return None
+
+    try:
+        since = decode_sync_token(token)
+    except ValueError:
+        abort(400, "Invalid sync token.")
+
+    if is_expired(since):
+        abort(410, "Sync token expired, fetch the full list again.")
+
+    return since
+
+
+def load_actor_names(app):
+    """warm-loads the actor name index used to resolve cast names"""
+    with app.app_context():
+        try:
+            actor_names.load(db.session.query(Actor.id, Actor.name))
+        except SQLAlchemyError:
+            # the tables may not exist yet, e.g. before the first migration
+            app.logger.warning("Could not load the actor name index")
+        finally:
+            db.session.remove()
 
 
 def create_app(test_config=None):
     app = Flask(__name__)
+    if test_config is not None:
+        app.config.update(test_config)
+    app.config.setdefault("SNAPSHOT_DIR", SNAPSHOT_DIR)
     setup_db(app)
+    # after_request hooks run in reverse order, so that the access log
+    # records the latency including the compression of the response
+    access_log.init_app(app)
+    query_log.install(app)
+    compression.init_app(app)
+    single_flight.init_app(app)
+    task_queue.init_app(app)
+    changes.init_app(app)
+    # registered after compression and coalescing, so that they see the
+    # Cache-Control header it sets
+    cache_policy.init_app(app)
 
     # Uncomment the following line on the initial run to setup
     # the required tables in the database
 
     # db_drop_and_create_all()
 
+    load_actor_names(app)
+
     CORS(app, resources={r"/*": {"origins": "*"}})
 
     @app.after_request
@@ -30,27 +194,81 @@ def create_app(test_config=None):
 
     @app.route('/actors')
     @requires_auth("get:actors")
+    @coalesce
+    @surrogate_keys("actors")
     def get_actors(payload):
-        actors_query = Actor.query.order_by(Actor.id).all()
-        actors = [actor.short() for actor in actors_query]
+        requested_ids = get_requested_ids()
+        if requested_ids is not None:
+            require_permission("get:actors-info", payload)
+            fields, include = get_projection(
+                Actor, ("id",) + Actor.LONG_FIELDS, True)
+            actors_query = load_many(Actor, requested_ids, fields, include)
+            actors = {actor.id: actor for actor in actors_query}
+            # the ids not found too, as they may be inserted later
+            tag_records("actor", requested_ids)
+
+            return jsonify({
+                "success": True,
+                "actors": [dict(actors[actor_id].project(fields, include),
+                                id=actor_id)
+                           for actor_id in requested_ids
+                           if actor_id in actors],
+                "not_found": [actor_id for actor_id in requested_ids
+                              if actor_id not in actors]
+            }), 200
+
+        fields, include = get_projection(Actor, Actor.SHORT_FIELDS, False)
+        if include or not set(fields) <= set(Actor.SHORT_FIELDS):
+            require_permission("get:actors-info", payload)
+        sync_token = new_sync_token()
+        since = get_updated_since()
+
+        if since is not None:
+            actors_query = changed_since(
+                Actor, since, projection_options(Actor, fields, include))
+            deleted = deleted_since("actor", since)
+            tag_records("actor", deleted)
+            tag_records("actor", [actor.id for actor in actors_query])
+
+            return jsonify({
+                "success": True,
+                "actors": [actor.project(fields, include)
+                           for actor in actors_query],
+                "deleted_actors": deleted,
+                "sync_token": sync_token
+            }), 200
+
+        actors_query = load_all(Actor, fields, include)
+        actors = [actor.project(fields, include) for actor in actors_query]
 
         return jsonify({
             "success": True,
-            "actors": actors
+            "actors": actors,
+            "sync_token": sync_token
         }), 200
 
     @app.route('/actors/<int:actor_id>')
     @requires_auth("get:actors-info")
+    @coalesce
+    @surrogate_keys("actor-{actor_id}")
     def get_actor_by_id(payload, actor_id):
-        actor = Actor.query.get_or_404(actor_id)
+        response = document_response("actor", actor_id)
+        if response is not None:
+            return response, 200
 
-        return jsonify({
+        fields, include = get_projection(Actor, Actor.LONG_FIELDS, True)
+        actor = load_one(Actor, actor_id, fields, include)
+        if actor is None:
+            abort(404)
+
+        return versioned(jsonify({
             "success": True,
-            "actor": actor.full_info()
-        }), 200
+            "actor": actor.project(fields, include)
+        }), actor.version), 200
 
     @app.route('/actors', methods=['POST'])
     @requires_auth("post:actor")
+    @idempotent
     def create_actor(payload):
         try:
             request_body = request.get_json()
@@ -67,7 +285,7 @@ def create_app(test_config=None):
                 full_name = request_body["full_name"]
 
             new_actor = Actor(request_body['name'], full_name,
-                              request_body['date_of_birth'])
+                              parse_date(request_body['date_of_birth']))
             new_actor.insert()
 
             return jsonify({
@@ -85,6 +303,7 @@ def create_app(test_config=None):
     @requires_auth("patch:actor")
     def update_actor(payload, actor_id):
         actor = Actor.query.get_or_404(actor_id)
+        check_if_match(actor.version)
 
         try:
             request_body = request.get_json()
@@ -107,14 +326,19 @@ def create_app(test_config=None):
                 if request_body["date_of_birth"] == "":
                     raise ValueError
 
-                actor.date_of_birth = request_body["date_of_birth"]
+                actor.date_of_birth = parse_date(
+                    request_body["date_of_birth"])
 
             actor.update()
 
-            return jsonify({
+            return versioned(jsonify({
                 "success": True,
                 "actor_info": actor.long()
-            }), 200
+            }), actor.version), 200
+
+        except StaleDataError:
+            db.session.rollback()
+            abort(412, "The resource was modified, fetch it again.")
 
         except (TypeError, ValueError, KeyError):
             abort(422)
@@ -140,27 +364,81 @@ def create_app(test_config=None):
 
     @app.route('/movies')
     @requires_auth("get:movies")
+    @coalesce
+    @surrogate_keys("movies")
     def get_movies(payload):
-        movies_query = Movie.query.order_by(Movie.id).all()
-        movies = [movie.short() for movie in movies_query]
+        requested_ids = get_requested_ids()
+        if requested_ids is not None:
+            require_permission("get:movies-info", payload)
+            fields, include = get_projection(
+                Movie, ("id",) + Movie.LONG_FIELDS, True)
+            movies_query = load_many(Movie, requested_ids, fields, include)
+            movies = {movie.id: movie for movie in movies_query}
+            # the ids not found too, as they may be inserted later
+            tag_records("movie", requested_ids)
+
+            return jsonify({
+                "success": True,
+                "movies": [dict(movies[movie_id].project(fields, include),
+                                id=movie_id)
+                           for movie_id in requested_ids
+                           if movie_id in movies],
+                "not_found": [movie_id for movie_id in requested_ids
+                              if movie_id not in movies]
+            }), 200
+
+        fields, include = get_projection(Movie, Movie.SHORT_FIELDS, False)
+        if include or not set(fields) <= set(Movie.SHORT_FIELDS):
+            require_permission("get:movies-info", payload)
+        sync_token = new_sync_token()
+        since = get_updated_since()
+
+        if since is not None:
+            movies_query = changed_since(
+                Movie, since, projection_options(Movie, fields, include))
+            deleted = deleted_since("movie", since)
+            tag_records("movie", deleted)
+            tag_records("movie", [movie.id for movie in movies_query])
+
+            return jsonify({
+                "success": True,
+                "movies": [movie.project(fields, include)
+                           for movie in movies_query],
+                "deleted_movies": deleted,
+                "sync_token": sync_token
+            }), 200
+
+        movies_query = load_all(Movie, fields, include)
+        movies = [movie.project(fields, include) for movie in movies_query]
 
         return jsonify({
             "success": True,
-            "movies": movies
+            "movies": movies,
+            "sync_token": sync_token
         }), 200
 
     @app.route('/movies/<int:movie_id>')
     @requires_auth("get:movies-info")
+    @coalesce
+    @surrogate_keys("movie-{movie_id}")
     def get_movie_by_id(payload, movie_id):
-        movie = Movie.query.get_or_404(movie_id)
+        response = document_response("movie", movie_id)
+        if response is not None:
+            return response, 200
 
-        return jsonify({
+        fields, include = get_projection(Movie, Movie.LONG_FIELDS, True)
+        movie = load_one(Movie, movie_id, fields, include)
+        if movie is None:
+            abort(404)
+
+        return versioned(jsonify({
             "success": True,
-            "movie": movie.full_info()
-        }), 200
+            "movie": movie.project(fields, include)
+        }), movie.version), 200
 
     @app.route('/movies', methods=['POST'])
     @requires_auth("post:movie")
+    @idempotent
     def create_movie(payload):
         try:
             request_body = request.get_json()
@@ -186,20 +464,17 @@ def create_app(test_config=None):
                 request_body['duration'],
                 request_body['imdb_rating']
             )
-            actors = Actor.query.filter(
-                Actor.name.in_(request_body["cast"])).all()
-
-            if len(request_body["cast"]) == len(actors):
-                new_movie.cast = actors
-                new_movie.insert()
-            else:
-                raise ValueError
+            new_movie.cast = resolve_cast(request_body["cast"])
+            new_movie.insert()
 
             return jsonify({
                 "success": True,
                 "created_movie_id": new_movie.id
             }), 201
 
+        except CastError as error:
+            abort(422, str(error))
+
         except (TypeError, KeyError, ValueError):
             abort(422)
 
@@ -210,6 +485,7 @@ def create_app(test_config=None):
     @requires_auth("patch:movie")
     def update_movie(payload, movie_id):
         movie = Movie.query.get_or_404(movie_id)
+        check_if_match(movie.version)
 
         try:
             request_body = request.get_json()
@@ -245,20 +521,21 @@ def create_app(test_config=None):
                 if len(request_body["cast"]) == 0:
                     raise ValueError
 
-                actors = Actor.query.filter(
-                    Actor.name.in_(request_body["cast"])).all()
-
-                if len(request_body["cast"]) == len(actors):
-                    movie.cast = actors
-                else:
-                    raise ValueError
+                movie.cast = resolve_cast(request_body["cast"])
 
             movie.update()
 
-            return jsonify({
+            return versioned(jsonify({
                 "success": True,
                 "movie_info": movie.long()
-            }), 200
+            }), movie.version), 200
+
+        except StaleDataError:
+            db.session.rollback()
+            abort(412, "The resource was modified, fetch it again.")
+
+        except CastError as error:
+            abort(422, str(error))
 
         except (TypeError, ValueError, KeyError):
             abort(422)
@@ -282,11 +559,95 @@ def create_app(test_config=None):
         except Exception:
             abort(500)
 
+    @app.route('/changes')
+    @requires_auth("get:movies")
+    def get_changes(payload):
+        broadcaster = changes.broadcaster()
+        last_event_id = request.headers.get(
+            "Last-Event-ID", request.args.get("last_event_id"))
+
+        try:
+            sequence = int(last_event_id) if last_event_id \
+                else broadcaster.sequence
+        except ValueError:
+            abort(400)
+
+        def stream(sequence):
+            while True:
+                events = broadcaster.wait(sequence, CHANGES_KEEPALIVE)
+
+                if events is None:
+                    sequence = broadcaster.sequence
+                    yield "id: {}\nevent: reset\ndata: {{}}\n\n".format(
+                        sequence)
+                elif not events:
+                    yield ": keep-alive\n\n"
+                else:
+                    for event in events:
+                        yield format_event(event)
+                    sequence = events[-1]["id"]
+
+        return Response(stream_with_context(stream(sequence)),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache",
+                                 "X-Accel-Buffering": "no"})
+
+    @app.route('/admin/queries')
+    @requires_auth("get:query-stats")
+    def get_query_stats(payload):
+        return jsonify({
+            "success": True,
+            "queries": query_log.stats()
+        }), 200
+
+    @app.route('/admin/stats')
+    @requires_auth("get:stats")
+    def get_stats(payload):
+        return jsonify({
+            "success": True,
+            "access_log": access_log.stats(),
+            "coalescing": single_flight.stats(),
+            "compression_cache": {
+                "hits": compression.cache.hits,
+                "misses": compression.cache.misses,
+                "size": compression.cache.size
+            }
+        }), 200
+
+    @app.route('/admin/tasks')
+    @requires_auth("get:task-stats")
+    def get_task_stats(payload):
+        return jsonify({
+            "success": True,
+            "tasks": task_queue.stats()
+        }), 200
+
+    @app.route('/admin/snapshots', methods=['POST'])
+    @requires_auth("post:snapshot")
+    def create_snapshot(payload):
+        body = request.get_json(silent=True) or {}
+
+        try:
+            manifest = write_snapshot(db.engine, app.config["SNAPSHOT_DIR"],
+                                      body.get("format", "arrow"))
+        except SnapshotError as error:
+            abort(422, str(error))
+        except (SQLAlchemyError, OSError):
+            abort(500)
+
+        return jsonify({
+            "success": True,
+            "snapshot": manifest
+        }), 201
+
     @app.errorhandler(400)
     @app.errorhandler(401)
     @app.errorhandler(403)
     @app.errorhandler(404)
     @app.errorhandler(405)
+    @app.errorhandler(409)
+    @app.errorhandler(410)
+    @app.errorhandler(412)
     @app.errorhandler(422)
     @app.errorhandler(500)
     def error_handler(error):
@@ -297,6 +658,3 @@ def create_app(test_config=None):
         }), error.code
 
     return app
-
-
-app = create_app()
@@ -1,5 +1,7 @@
 import json
-from flask import request, abort
+import threading
+import time
+from flask import request, abort, g
 from functools import wraps
 
 from jose import jwt
@@ -9,6 +11,12 @@ AUTH0_DOMAIN = 'ry-fsnd.auth0.com'
 ALGORITHMS = ['RS256']
 API_AUDIENCE = 'fsnd-capstone'
 
+# seconds the key set fetched from Auth0 is used before it is fetched again
+JWKS_TTL = 600
+
+# a token signed with an unknown key refetches the key set at most this often
+JWKS_REFRESH_INTERVAL = 60
+
 
 # AuthError Exception
 class AuthError(Exception):
@@ -63,12 +71,57 @@ def check_permissions(permission, payload):
     return True
 
 
+class JWKSCache:
+    """
+    Keeps the JSON Web Key Set tokens are verified against, so that it isn't
+    fetched from Auth0 on every request. A key set can also be pinned, e.g.
+    to a locally generated one in tests, and is then never fetched.
+    """
+
+    def __init__(self, url, ttl=JWKS_TTL):
+        self.url = url
+        self.ttl = ttl
+        self.pinned = False
+        self._jwks = None
+        self._fetched_at = 0
+        self._lock = threading.Lock()
+
+    def pin(self, jwks):
+        with self._lock:
+            self._jwks = jwks
+            self.pinned = True
+
+    def get(self, refresh=False):
+        """returns the key set, fetching it first if it is outdated"""
+        with self._lock:
+            age = time.time() - self._fetched_at
+            if not self.pinned and (self._jwks is None or age > self.ttl or
+                                    refresh and age > JWKS_REFRESH_INTERVAL):
+                self._jwks = json.loads(urlopen(self.url).read())
+                self._fetched_at = time.time()
+
+            return self._jwks
+
+
+jwks = JWKSCache("https://{}/.well-known/jwks.json".format(AUTH0_DOMAIN))
+
+
+def find_rsa_key(key_set, kid):
+    for key in key_set['keys']:
+        if key['kid'] == kid:
+            return {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+
+    return {}
+
+
 def verify_decode_jwt(token):
-    url_string = "https://{}/.well-known/jwks.json".format(AUTH0_DOMAIN)
-    json_url = urlopen(url_string)
-    jwks = json.loads(json_url.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
 
     if 'kid' not in unverified_header:
         raise AuthError({
@@ -76,15 +129,11 @@ def verify_decode_jwt(token):
             'description': 'Authorization Header is malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = find_rsa_key(jwks.get(), unverified_header['kid'])
+    if not rsa_key:
+        # the signing keys may have been rotated since they were fetched
+        rsa_key = find_rsa_key(jwks.get(refresh=True),
+                               unverified_header['kid'])
 
     if rsa_key:
         try:
@@ -135,6 +184,9 @@ def requires_auth(permission=''):
                 raise abort(authError.status_code,
                             authError.error["description"])
 
+            # identifies the user in the access log
+            g.jwt_sub = payload.get("sub")
+
             return f(payload, *args, **kwargs)
 
         return wrapper
@@ -0,0 +1,74 @@
+import base64
+import time
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from jose import jwt
+
+from auth.auth import ALGORITHMS, API_AUDIENCE, AUTH0_DOMAIN, jwks
+
+KEY_ID = 'local-test-key'
+
+# the permissions of the roles described in the README
+USER_PERMISSIONS = ['get:actors', 'get:actors-info', 'get:movies',
+                    'get:movies-info']
+MANAGER_PERMISSIONS = USER_PERMISSIONS + ['patch:actor', 'patch:movie',
+                                          'post:actor', 'post:movie']
+ADMIN_PERMISSIONS = MANAGER_PERMISSIONS + ['delete:actor', 'delete:movie',
+                                           'get:query-stats', 'get:stats',
+                                           'get:task-stats', 'post:snapshot']
+
+_private_key = None
+
+
+def base64url_uint(value):
+    data = value.to_bytes((value.bit_length() + 7) // 8, 'big')
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode()
+
+
+def private_key():
+    """generates the signing key once per process"""
+    global _private_key
+    if _private_key is None:
+        _private_key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend())
+
+    return _private_key
+
+
+def local_jwks():
+    numbers = private_key().public_key().public_numbers()
+    return {
+        'keys': [{
+            'kty': 'RSA',
+            'kid': KEY_ID,
+            'use': 'sig',
+            'alg': ALGORITHMS[0],
+            'n': base64url_uint(numbers.n),
+            'e': base64url_uint(numbers.e)
+        }]
+    }
+
+
+def install_local_keys():
+    """makes auth.auth verify tokens against the local key only"""
+    jwks.pin(local_jwks())
+
+
+def make_token(permissions, sub='auth0|local-test-user', expires_in=3600):
+    """returns a token signed with the local key, as Auth0 would issue it"""
+    pem = private_key().private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption())
+    now = int(time.time())
+
+    return jwt.encode({
+        'iss': 'https://{}/'.format(AUTH0_DOMAIN),
+        'sub': sub,
+        'aud': API_AUDIENCE,
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': permissions
+    }, pem.decode(), algorithm=ALGORITHMS[0], headers={'kid': KEY_ID})
@@ -0,0 +1,125 @@
+"""
+Micro-benchmark of the hot queries of the read routes, built and compiled
+for every call as the ORM does vs the baked statements of
+database/statements.py, on a temporary SQLite database.
+
+    python benchmark.py [--records 1000] [--calls 2000]
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from datetime import date
+
+from sqlalchemy import func
+
+from app import create_app
+from database.models import db, Actor, Document, Movie, projection_options
+from database.cast import actors_named
+from database.statements import load_one, load_many, load_all
+from database.documents import fetch_document, build_documents
+
+
+def seed(records):
+    actors = [Actor("Actor {}".format(number), "Actor Number {}".format(
+        number), date(1980, 1, 1)) for number in range(records)]
+    movies = [Movie("Movie {}".format(number), 2000, 100, 7.0)
+              for number in range(records // 10)]
+    for number, movie in enumerate(movies):
+        movie.cast = actors[number * 10:number * 10 + 10]
+
+    db.session.add_all(actors + movies)
+    db.session.commit()
+
+
+def orm_names(names):
+    return db.session.query(Actor.id, Actor.name) \
+        .filter(func.lower(Actor.name).in_(names)).all()
+
+
+def orm_document(entity, entity_id):
+    return db.session.query(Document.body, Document.version) \
+        .filter(Document.entity == entity, Document.entity_id == entity_id,
+                Document.body.isnot(None)).first()
+
+
+def cases(records):
+    long_fields = Actor.LONG_FIELDS
+    ids = list(range(1, 21))
+    names = ["actor {}".format(number) for number in range(5)]
+    last = records // 10
+
+    return [
+        ("detail (fields/include)",
+         lambda i: Actor.query
+         .options(*projection_options(Actor, long_fields, True))
+         .get(i % records + 1),
+         lambda i: load_one(Actor, i % records + 1, long_fields, True)),
+        ("detail document",
+         lambda i: orm_document("actor", i % records + 1),
+         lambda i: fetch_document("actor", i % records + 1)),
+        ("multi-get (20 ids)",
+         lambda i: Actor.query
+         .options(*projection_options(Actor, long_fields, True))
+         .filter(Actor.id.in_(ids)).all(),
+         lambda i: load_many(Actor, ids, long_fields, True)),
+        ("cast name lookup",
+         lambda i: orm_names(names),
+         lambda i: actors_named(names)),
+        ("list ({} movies)".format(last),
+         lambda i: Movie.query
+         .options(*projection_options(Movie, Movie.SHORT_FIELDS))
+         .order_by(Movie.id).all(),
+         lambda i: load_all(Movie, Movie.SHORT_FIELDS))
+    ]
+
+
+def measure(query, calls):
+    """returns the CPU time of a call in microseconds"""
+    for i in range(min(calls, 50)):
+        query(i)
+        db.session.remove()
+
+    start = time.process_time()
+    for i in range(calls):
+        query(i)
+        # as at the end of a request, so no call finds the identity map warm
+        db.session.remove()
+
+    return (time.process_time() - start) / calls * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--records", type=int, default=1000)
+    parser.add_argument("--calls", type=int, default=2000)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="capstone-benchmark-")
+    try:
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(
+                directory, "benchmark.db"),
+            "ACCESS_LOG": False,
+            "TASK_WORKERS": 0,
+            "SLOW_QUERY_THRESHOLD": 10 ** 6
+        })
+        with app.app_context():
+            db.create_all()
+            seed(args.records)
+            build_documents()
+
+            print("{:<26}{:>12}{:>12}{:>10}".format(
+                "query", "ORM (us)", "baked (us)", "saved"))
+            for name, orm, baked in cases(args.records):
+                orm_time = measure(orm, args.calls)
+                baked_time = measure(baked, args.calls)
+                print("{:<26}{:>12.1f}{:>12.1f}{:>9.0%}".format(
+                    name, orm_time, baked_time, 1 - baked_time / orm_time))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
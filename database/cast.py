@@ -0,0 +1,114 @@
+from sqlalchemy import bindparam, func, or_
+
+from database.models import db, Actor
+from database.name_index import actor_names, normalize
+from database.statements import bakery
+
+
+class CastError(ValueError):
+    """raised when the cast of a movie can't be resolved to actors"""
+
+
+def actors_named(names):
+    """returns the id and name of the actors with the normalized names"""
+    query = bakery(lambda session: session.query(Actor.id, Actor.name))
+    query += lambda q: q.filter(
+        func.lower(Actor.name).in_(bindparam("names", expanding=True)))
+
+    return query(db.session()).params(names=sorted(names)).all()
+
+
+def lookup_names(names):
+    """
+    resolves names to actor ids with the name index, querying the
+    database once for all the names the index doesn't know, returns the
+    ids by name and the normalized names found in the index
+    """
+    resolved = {name: actor_names.lookup(name) for name in names}
+    missing = {normalize(name) for name, ids in resolved.items()
+               if ids is None}
+    indexed = {normalize(name) for name in names} - missing
+
+    if missing:
+        found = {}
+        for actor_id, name in actors_named(missing):
+            found.setdefault(normalize(name), set()).add(actor_id)
+
+        for key, actor_ids in found.items():
+            actor_names.set(key, actor_ids)
+
+        for name, ids in resolved.items():
+            if ids is None:
+                resolved[name] = found.get(normalize(name), set())
+
+    return resolved, indexed
+
+
+def load_cast(actor_ids, names):
+    """
+    returns the actors with the ids and all the actors with the normalized
+    names, in one query
+    """
+    query = bakery(lambda session: session.query(Actor))
+    query += lambda q: q.filter(or_(
+        Actor.id.in_(bindparam("ids", expanding=True)),
+        func.lower(Actor.name).in_(bindparam("names", expanding=True))))
+
+    return query(db.session()).params(ids=sorted(actor_ids),
+                                      names=sorted(names)).all()
+
+
+def resolve_cast(cast):
+    """
+    returns the actors for a cast given as a list of actor names or ids
+    raises CastError for unknown ids, unknown names and ambiguous names
+    """
+    if not isinstance(cast, list) or not cast \
+            or not all(isinstance(member, (int, str))
+                       and not isinstance(member, bool) for member in cast):
+        raise CastError("cast must be a non-empty list of actor names or ids.")
+
+    names = [member for member in cast if isinstance(member, str)]
+    actor_ids = {member for member in cast if isinstance(member, int)}
+    resolved, indexed = lookup_names(names)
+
+    # the index doesn't know of the namesakes added by other workers or by
+    # an import, so the names it resolved are checked against the actors
+    # loaded with the cast
+    loaded = load_cast(actor_ids.union(*resolved.values()), indexed)
+    actors = {actor.id: actor for actor in loaded}
+    namesakes = {}
+    for actor in loaded:
+        key = normalize(actor.name)
+        if key in indexed:
+            namesakes.setdefault(key, set()).add(actor.id)
+
+    by_name = {}
+    for name, ids in resolved.items():
+        key = normalize(name)
+        if key not in indexed:
+            ids = ids & set(actors)
+        elif namesakes.get(key, set()) != ids:
+            ids = namesakes.get(key, set())
+            if ids:
+                actor_names.set(key, ids)
+            else:
+                actor_names.discard(key)
+
+        if not ids:
+            raise CastError("Unknown actor: {}.".format(name))
+        if len(ids) > 1:
+            raise CastError(
+                "Ambiguous actor name: {} matches actors {}, "
+                "pass one of the ids instead.".format(
+                    name, ", ".join(str(actor_id)
+                                    for actor_id in sorted(ids))))
+        by_name[name] = next(iter(ids))
+
+    unknown = sorted(actor_ids - set(actors))
+    if unknown:
+        raise CastError("Unknown actor ids: {}.".format(
+            ", ".join(str(actor_id) for actor_id in unknown)))
+
+    return [actors[actor_id]
+            for actor_id in sorted(actor_ids | set(by_name.values()))]
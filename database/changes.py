@@ -0,0 +1,287 @@
+import json
+import logging
+import os
+import threading
+from collections import deque
+from datetime import datetime, timedelta
+from select import select as wait_readable
+
+from flask import current_app
+from sqlalchemy import event, func, select, text
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger("changes")
+
+# number of recent events kept so that reconnecting clients can resume
+CHANGE_BACKLOG = 1024
+
+# seconds between reads of the change_events table when no write woke the
+# feed, e.g. for the writes of other workers on SQLite
+CHANGE_POLL_INTERVAL = float(os.environ.get("CHANGE_POLL_INTERVAL", 1))
+
+# events read from the change_events table per query
+CHANGE_BATCH_SIZE = 500
+
+# seconds a gap in the event ids is waited for before it is skipped; an
+# earlier id may belong to a transaction that hasn't committed yet, or to
+# one that was rolled back
+CHANGE_GAP_TIMEOUT = 5
+
+# events older than this are pruned
+CHANGE_EVENT_RETENTION = timedelta(days=1)
+
+# PostgreSQL channel notified by the transactions that add events
+CHANGE_CHANNEL = "catalog_changes"
+
+
+class ChangeBroadcaster:
+    """
+    In-process fan-out of the change events of one app to its /changes
+    subscribers, which all wait on the same condition. Under gunicorn's
+    gevent worker, threading is monkey-patched, so a waiting subscriber is
+    a parked greenlet rather than a blocked thread.
+
+    A feed thread reads the events every worker adds to the change_events
+    table, so that subscribers see the changes made through any worker,
+    and event ids (the ids of the table) are the same in every worker.
+    """
+
+    def __init__(self, feed, app, backlog=CHANGE_BACKLOG):
+        self.feed = feed
+        self.app = app
+        self._events = deque(maxlen=backlog)
+        # the id of the last event published, and the one after which all
+        # the events are buffered, None until the table was first read
+        self._sequence = None
+        self._floor = None
+        self._condition = threading.Condition()
+        self._polling = threading.Lock()
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def sequence(self):
+        if self._sequence is None:
+            self.poll()
+
+        return self._sequence
+
+    def start(self):
+        if self._thread is not None:
+            return
+
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self.follow, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def wake(self):
+        """reads the table right away, e.g. after a write of this worker"""
+        self._wake.set()
+
+    def follow(self):
+        listener = None
+        while not self._stopping.is_set():
+            with self.app.app_context():
+                try:
+                    listener = listener or self.feed.listen()
+                    self.poll()
+                except Exception:
+                    logger.exception("Could not read the change events")
+
+            try:
+                if listener is not None:
+                    listener.wait(CHANGE_POLL_INTERVAL)
+                else:
+                    self._wake.wait(CHANGE_POLL_INTERVAL)
+            except Exception:
+                logger.exception("Lost the change events listener")
+                listener.close()
+                listener = None
+                # not reconnected right away, so that a failing listener
+                # doesn't turn into a busy loop
+                self._stopping.wait(CHANGE_POLL_INTERVAL)
+            self._wake.clear()
+
+        if listener is not None:
+            listener.close()
+
+    def poll(self):
+        """publishes the events committed since the last poll"""
+        with self._polling:
+            self._poll()
+
+    def _poll(self):
+        table = self.feed.model.__table__
+        # on a connection of its own, so that a stream never holds one
+        with self.feed.db.engine.connect() as connection:
+            if self._sequence is None:
+                # new subscribers only get the events from now on
+                latest = connection.execute(
+                    select([func.max(table.c.id)])).scalar() or 0
+                with self._condition:
+                    self._sequence = self._floor = latest
+                return
+
+            rows = connection.execute(
+                table.select().where(table.c.id > self._sequence)
+                .order_by(table.c.id).limit(CHANGE_BATCH_SIZE)).fetchall()
+
+        gap_timeout = datetime.utcnow() - timedelta(
+            seconds=CHANGE_GAP_TIMEOUT)
+        events, expected = [], self._sequence + 1
+        for row in rows:
+            if row.id != expected and row.created_at > gap_timeout:
+                break
+            events.append({
+                "id": row.id,
+                "entity": row.entity,
+                "action": row.action,
+                "data": json.loads(row.data)
+            })
+            expected = row.id + 1
+
+        self.publish(events)
+
+    def publish(self, events):
+        if not events:
+            return
+
+        with self._condition:
+            for change in events:
+                if len(self._events) == self._events.maxlen:
+                    self._floor = self._events[0]["id"]
+                self._events.append(change)
+                self._sequence = change["id"]
+            self._condition.notify_all()
+
+    def events_after(self, sequence):
+        """
+        returns the buffered events newer than sequence, or None when
+        the events after sequence are no longer (or never were) buffered
+        and the client has to resync from scratch
+        """
+        with self._condition:
+            if self._sequence is None or sequence > self._sequence \
+                    or sequence < self._floor:
+                return None
+
+            return [change for change in self._events
+                    if change["id"] > sequence]
+
+    def wait(self, sequence, timeout=None):
+        """blocks until there are events newer than sequence or timeout"""
+        with self._condition:
+            self._condition.wait_for(lambda: self._sequence != sequence,
+                                     timeout)
+
+        return self.events_after(sequence)
+
+
+class PostgresListener:
+    """a connection LISTENing to the channel of the change events"""
+
+    def __init__(self, engine):
+        # detached, so that the connection isn't given back to the pool in
+        # autocommit mode
+        self.connection = engine.raw_connection()
+        self.connection.detach()
+        self.connection.connection.set_isolation_level(0)
+        cursor = self.connection.cursor()
+        cursor.execute("LISTEN {}".format(CHANGE_CHANNEL))
+        cursor.close()
+
+    def wait(self, timeout):
+        dbapi_connection = self.connection.connection
+        wait_readable([dbapi_connection], [], [], timeout)
+        dbapi_connection.poll()
+        dbapi_connection.notifies.clear()
+
+    def close(self):
+        self.connection.close()
+
+
+class ChangeFeed:
+    """
+    Records the catalog changes in the transaction of the write, and gives
+    each app a broadcaster fed from them. The feed thread is started by
+    the first request the app serves, so creating an app starts none.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.model = None
+
+    def init_app(self, app):
+        # imported here as the models record their changes through this
+        # module
+        from database.models import db, ChangeEvent
+
+        self.db = db
+        self.model = ChangeEvent
+        app.config.setdefault("CHANGE_FEED", True)
+
+        if not event.contains(Session, "after_commit", self.after_commit):
+            event.listen(Session, "after_commit", self.after_commit)
+            event.listen(Session, "after_soft_rollback", self.after_rollback)
+
+        broadcaster = app.extensions["changes"] = ChangeBroadcaster(self, app)
+        if app.config["CHANGE_FEED"]:
+            app.before_first_request(broadcaster.start)
+
+    @staticmethod
+    def broadcaster(app=None):
+        """the broadcaster of the app, by default of the current one"""
+        app = app or current_app._get_current_object()
+        return app.extensions["changes"]
+
+    def record(self, entity, action, data):
+        """adds a change event to the transaction of the change"""
+        session = self.db.session
+        session.add(self.model(entity, action, data))
+
+        if not session.info.get("change_events"):
+            session.info["change_events"] = True
+            # delivered to the listeners once the transaction commits
+            if self.db.engine.dialect.name == "postgresql":
+                session.execute(text("NOTIFY {}".format(CHANGE_CHANNEL)))
+
+    def listen(self):
+        """a listener for the commits of other workers, if supported"""
+        if self.db.engine.dialect.name == "postgresql":
+            return PostgresListener(self.db.engine)
+
+        return None
+
+    @staticmethod
+    def after_commit(session):
+        if session.info.pop("change_events", None):
+            app = getattr(session, "app", None)
+            broadcaster = app and app.extensions.get("changes")
+            if broadcaster is not None:
+                broadcaster.wake()
+
+    @staticmethod
+    def after_rollback(session, previous_transaction):
+        session.info.pop("change_events", None)
+
+
+changes = ChangeFeed()
+
+
+def prune_change_events():
+    """deletes the change events older than the retention period"""
+    model = changes.model
+    cutoff = datetime.utcnow() - CHANGE_EVENT_RETENTION
+    pruned = model.query.filter(model.created_at < cutoff) \
+        .delete(synchronize_session=False)
+    changes.db.session.commit()
+
+    return pruned
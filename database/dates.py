@@ -0,0 +1,14 @@
+from datetime import datetime
+
+# accepted in request bodies and imported files
+DATE_FORMATS = ("%Y-%m-%d", "%B %d, %Y")
+
+
+def parse_date(value):
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(value, date_format).date()
+        except ValueError:
+            pass
+
+    raise ValueError("Unknown date format: {}".format(value))
@@ -0,0 +1,126 @@
+import json
+
+from sqlalchemy import and_, bindparam
+from sqlalchemy.exc import IntegrityError
+
+from database.models import db, Actor, Document, Movie
+from database.outbox import task_queue
+from database.statements import bakery, execute_prepared, load_many
+
+MODELS = {"movie": Movie, "actor": Actor}
+
+# records loaded per query when all documents are rebuilt
+BUILD_BATCH_SIZE = 500
+
+documents = Document.__table__
+
+UPDATE_DOCUMENT = documents.update() \
+    .where(and_(documents.c.entity == bindparam("_entity"),
+                documents.c.entity_id == bindparam("_entity_id"),
+                documents.c.generation == bindparam("_generation"))) \
+    .values(version=bindparam("version"), body=bindparam("body"))
+
+
+def encode_document(instance):
+    """encodes the default response of the detail route of a movie or actor"""
+    model = type(instance)
+    return json.dumps({
+        "success": True,
+        model.__name__.lower(): instance.project(model.LONG_FIELDS, True)
+    }, sort_keys=True, separators=(",", ":")) + "\n"
+
+
+def fetch_document(entity, entity_id):
+    """returns the body and version of a document, None if it is stale"""
+    if db.engine.dialect.name == "postgresql":
+        return execute_prepared("fetch_document", entity, entity_id).first()
+
+    query = bakery(lambda session: session.query(Document.body,
+                                                 Document.version))
+    query += lambda q: q.filter(Document.entity == bindparam("entity"),
+                                Document.entity_id == bindparam("entity_id"),
+                                Document.body.isnot(None))
+
+    return query(db.session()) \
+        .params(entity=entity, entity_id=entity_id).first()
+
+
+def store_documents(entity, instances, generations):
+    """
+    stores the documents of the movies or actors, except those that changed
+    since their generation was read, which the task of the change stores
+    """
+    inserts, updates = [], []
+    for instance in instances:
+        document = {
+            "version": instance.version,
+            "body": encode_document(instance)
+        }
+        generation = generations.get(instance.id)
+        if generation is None:
+            inserts.append(dict(document, entity=entity,
+                                entity_id=instance.id, generation=0))
+        else:
+            updates.append(dict(document, _entity=entity,
+                                _entity_id=instance.id,
+                                _generation=generation))
+
+    if inserts:
+        db.session.execute(documents.insert(), inserts)
+    if updates:
+        db.session.execute(UPDATE_DOCUMENT, updates)
+
+
+def load(model, entity_ids):
+    return load_many(model, entity_ids, model.LONG_FIELDS, True)
+
+
+def refresh_document(entity, entity_id):
+    model = MODELS[entity]
+    # read before the movie or actor, so that a change committed in between
+    # bumps it and the stale document isn't stored
+    generation = db.session.query(Document.generation) \
+        .filter_by(entity=entity, entity_id=entity_id).scalar()
+
+    try:
+        store_documents(entity, load(model, [entity_id]),
+                        {entity_id: generation})
+        db.session.commit()
+    except IntegrityError:
+        # another worker stored the first document of the record
+        db.session.rollback()
+
+
+@task_queue.handler("changed")
+def refresh_changed_documents(entity, id, action, related):
+    if action != "delete":
+        refresh_document(entity, id)
+
+    for related_id in related:
+        refresh_document(MODELS[entity].RELATED_ENTITY, related_id)
+
+
+def build_documents():
+    """(re)generates the documents of all movies and actors"""
+    built = 0
+    for entity, model in MODELS.items():
+        ids = [entity_id for entity_id, in db.session.query(model.id)]
+        for start in range(0, len(ids), BUILD_BATCH_SIZE):
+            batch = ids[start:start + BUILD_BATCH_SIZE]
+            generations = dict(
+                db.session.query(Document.entity_id, Document.generation)
+                .filter(Document.entity == entity,
+                        Document.entity_id.in_(batch)))
+            instances = load(model, batch)
+
+            try:
+                store_documents(entity, instances, generations)
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+                for entity_id in batch:
+                    refresh_document(entity, entity_id)
+            built += len(instances)
+            db.session.expunge_all()
+
+    return built
@@ -0,0 +1,364 @@
+import csv
+import io
+import json
+import os
+import time
+from datetime import datetime
+from itertools import groupby
+
+from sqlalchemy import text
+
+from database.dates import parse_date
+from database.models import OutboxTask
+from database.outbox import task_queue
+
+# rows sent to the database per COPY chunk or executemany batch
+BATCH_SIZE = 50000
+
+# surrogate keys per "purge_keys" task, Fastly's batch purge takes up to 256
+PURGE_BATCH_SIZE = 256
+
+# the entity of the documents of the catalog tables
+ENTITIES = {"actors": "actor", "movies": "movie"}
+
+STAGING_TABLES = {
+    "staging_actors": (
+        ("name", "VARCHAR(256)"),
+        ("full_name", "VARCHAR(512)"),
+        ("date_of_birth", "DATE")
+    ),
+    "staging_movies": (
+        ("title", "VARCHAR(256)"),
+        ("release_year", "INTEGER"),
+        ("duration", "INTEGER"),
+        ("imdb_rating", "FLOAT")
+    ),
+    "staging_cast": (
+        ("title", "VARCHAR(256)"),
+        ("release_year", "INTEGER"),
+        ("actor_id", "INTEGER"),
+        ("actor_name", "VARCHAR(256)"),
+        ("date_of_birth", "DATE")
+    ),
+    # the actors of the cast rows without actor_id, by name and birth date
+    "staging_matches": (
+        ("actor_name", "VARCHAR(256)"),
+        ("date_of_birth", "DATE"),
+        ("actor_id", "INTEGER"),
+        ("matches", "INTEGER")
+    ),
+    # the links of the cast rows that are not in the catalog yet
+    "staging_links": (
+        ("actor_id", "INTEGER"),
+        ("movie_id", "INTEGER")
+    )
+}
+
+# each statement inserts the staged rows that are not in the catalog yet,
+# so running the same import again does not create duplicates. The anti
+# joins are written as LEFT JOINs so that SQLite builds automatic indexes
+# instead of scanning the catalog tables once per staged row. The rows are
+# stamped again just before the commit, see TOUCH_NEW. COPY reads the
+# empty full names as NULL, hence the COALESCE.
+MERGE_ACTORS = """
+INSERT INTO actors (name, full_name, date_of_birth, updated_at)
+SELECT s.name, COALESCE(MAX(s.full_name), ''), s.date_of_birth,
+       :stamped_at
+FROM staging_actors s
+LEFT JOIN actors a
+ON a.name = s.name AND a.date_of_birth = s.date_of_birth
+WHERE a.id IS NULL
+GROUP BY s.name, s.date_of_birth
+"""
+
+MERGE_MOVIES = """
+INSERT INTO movies (title, release_year, duration, imdb_rating, updated_at)
+SELECT s.title, s.release_year, MAX(s.duration), MAX(s.imdb_rating),
+       :stamped_at
+FROM staging_movies s
+LEFT JOIN movies m
+ON m.title = s.title AND m.release_year = s.release_year
+WHERE m.id IS NULL
+GROUP BY s.title, s.release_year
+"""
+
+# actors are identified like on import, by name and date of birth, unless
+# the cast row gives the actor_id
+MATCH_CAST_ACTORS = """
+INSERT INTO staging_matches (actor_name, date_of_birth, actor_id, matches)
+SELECT s.actor_name, s.date_of_birth, MIN(a.id), COUNT(*)
+FROM (SELECT DISTINCT actor_name, date_of_birth
+      FROM staging_cast
+      WHERE actor_id IS NULL) s
+JOIN actors a
+ON a.name = s.actor_name AND a.date_of_birth = s.date_of_birth
+GROUP BY s.actor_name, s.date_of_birth
+"""
+
+# the cast rows resolved to exactly one movie and one actor, joined with
+# staging_matches (NULL unless the name and date of birth of the row
+# matched a single actor)
+RESOLVED_CAST = """
+FROM staging_cast s
+LEFT JOIN movies m ON m.title = s.title AND m.release_year = s.release_year
+LEFT JOIN staging_matches n
+ON n.actor_name = s.actor_name AND n.date_of_birth = s.date_of_birth
+AND n.matches = 1
+LEFT JOIN actors a ON a.id = COALESCE(s.actor_id, n.actor_id)
+"""
+
+NEW_CAST_LINKS = """
+INSERT INTO staging_links (actor_id, movie_id)
+SELECT DISTINCT a.id, m.id
+""" + RESOLVED_CAST + """
+LEFT JOIN actor_in_movie l ON l.actor_id = a.id AND l.movie_id = m.id
+WHERE m.id IS NOT NULL AND a.id IS NOT NULL AND l.actor_id IS NULL
+"""
+
+MERGE_CAST = """
+INSERT INTO actor_in_movie (actor_id, movie_id)
+SELECT actor_id, movie_id FROM staging_links
+"""
+
+UNRESOLVED_CAST = """
+SELECT COUNT(*)
+""" + RESOLVED_CAST + """
+WHERE m.id IS NULL OR a.id IS NULL
+"""
+
+AMBIGUOUS_CAST = """
+SELECT n.actor_name, n.date_of_birth, a.id
+FROM staging_matches n
+JOIN actors a
+ON a.name = n.actor_name AND a.date_of_birth = n.date_of_birth
+WHERE n.matches > 1
+ORDER BY n.actor_name, n.date_of_birth, a.id
+"""
+
+# as record_change does for a change through the API, the documents of the
+# records that got new cast links are cleared, and the new records get an
+# empty document, all built by `manage.py documents`
+INVALIDATE_LINKED_DOCUMENTS = """
+UPDATE documents SET generation = generation + 1, body = NULL
+WHERE (entity = 'movie'
+       AND entity_id IN (SELECT movie_id FROM staging_links))
+OR (entity = 'actor'
+    AND entity_id IN (SELECT actor_id FROM staging_links))
+"""
+
+INSERT_NEW_DOCUMENTS = """
+INSERT INTO documents (entity, entity_id, generation)
+SELECT :entity, r.id, 0
+FROM {} r
+LEFT JOIN documents d ON d.entity = :entity AND d.entity_id = r.id
+WHERE r.id > :last_id AND d.entity_id IS NULL
+"""
+
+# the records whose cached responses the import makes outdated: those that
+# got new cast links, and the new ones, which multi-gets may have cached as
+# not found
+PURGED_IDS = """
+SELECT {column} FROM staging_links
+UNION
+SELECT id FROM {table} WHERE id > :last_id
+"""
+
+# the sync tokens handed out while the import ran must not skip its rows,
+# so they are stamped with the time of the commit rather than of the start
+TOUCH_NEW = "UPDATE {} SET updated_at = :stamped_at WHERE id > :last_id"
+
+# as for a cast change through the API, a movie that got new links is
+# updated and gets a new version
+TOUCH_LINKED_MOVIES = """
+UPDATE movies SET updated_at = :stamped_at, version = version + 1
+WHERE id <= :last_id AND id IN (SELECT movie_id FROM staging_links)
+"""
+
+
+def read_records(path):
+    """yields one dict per row of a CSV or NDJSON file"""
+    extension = os.path.splitext(path)[1].lower()
+
+    with open(path, newline='') as source:
+        if extension == ".csv":
+            for record in csv.DictReader(source):
+                yield record
+        elif extension in (".ndjson", ".jsonl"):
+            for line in source:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            raise ValueError("Unsupported file type: {}".format(path))
+
+
+def actor_rows(path):
+    for record in read_records(path):
+        yield (record["name"], record.get("full_name") or "",
+               parse_date(record["date_of_birth"]))
+
+
+def movie_rows(path):
+    for record in read_records(path):
+        yield (record["title"], int(record["release_year"]),
+               int(record["duration"]), float(record["imdb_rating"]))
+
+
+def cast_rows(path):
+    for record in read_records(path):
+        # a name alone may belong to several actors
+        actor_id = record.get("actor_id")
+        date_of_birth = record.get("date_of_birth")
+        if not actor_id and not (record.get("actor_name") and date_of_birth):
+            raise ValueError(
+                "Cast rows need the actor_id, or the actor_name and "
+                "date_of_birth of the actor: {}".format(record))
+
+        yield (record["title"], int(record["release_year"]),
+               int(actor_id) if actor_id else None,
+               record.get("actor_name") or None,
+               parse_date(date_of_birth) if date_of_birth else None)
+
+
+def batches(rows, size=BATCH_SIZE):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+
+    if batch:
+        yield batch
+
+
+class CatalogImporter:
+    """
+    Bulk loads actors, movies and cast links.
+    Rows are streamed into temporary staging tables, with COPY on
+    PostgreSQL and executemany everywhere else, and then merged into the
+    catalog with one set-based statement per table inside one transaction.
+    """
+
+    def __init__(self, engine, report=print):
+        self.engine = engine
+        self.report = report
+        self.is_postgres = engine.dialect.name == "postgresql"
+
+    def run(self, actors=None, movies=None, cast=None):
+        started = time.time()
+        staged = 0
+
+        with self.engine.begin() as connection:
+            self.create_staging_tables(connection)
+
+            sources = (("staging_actors", actors, actor_rows),
+                       ("staging_movies", movies, movie_rows),
+                       ("staging_cast", cast, cast_rows))
+            for table, path, rows in sources:
+                if path:
+                    staged += self.stage(connection, table, rows(path))
+
+            if self.is_postgres:
+                connection.execute("ANALYZE staging_cast")
+
+            last_ids = {table: connection.execute(
+                "SELECT COALESCE(MAX(id), 0) FROM {}".format(table)).scalar()
+                for table in ENTITIES}
+            stamped_at = datetime.utcnow()
+            results = {
+                "actors": connection.execute(
+                    text(MERGE_ACTORS), stamped_at=stamped_at).rowcount,
+                "movies": connection.execute(
+                    text(MERGE_MOVIES), stamped_at=stamped_at).rowcount
+            }
+            connection.execute(MATCH_CAST_ACTORS)
+            connection.execute(NEW_CAST_LINKS)
+            results["cast links"] = connection.execute(MERGE_CAST).rowcount
+            connection.execute(INVALIDATE_LINKED_DOCUMENTS)
+            for table, last_id in last_ids.items():
+                connection.execute(text(INSERT_NEW_DOCUMENTS.format(table)),
+                                   entity=ENTITIES[table], last_id=last_id)
+            unresolved = connection.execute(UNRESOLVED_CAST).scalar()
+            ambiguous = connection.execute(AMBIGUOUS_CAST).fetchall()
+
+            if task_queue.handles("purge_keys"):
+                self.enqueue_purges(connection, last_ids)
+
+            # the last statements of the transaction
+            stamped_at = datetime.utcnow()
+            for table, last_id in last_ids.items():
+                connection.execute(text(TOUCH_NEW.format(table)),
+                                   stamped_at=stamped_at, last_id=last_id)
+            connection.execute(text(TOUCH_LINKED_MOVIES),
+                               stamped_at=stamped_at,
+                               last_id=last_ids["movies"])
+
+        elapsed = time.time() - started
+        for name, inserted in results.items():
+            self.report("Inserted {} new {}".format(inserted, name))
+        for (name, date_of_birth), matches in groupby(
+                ambiguous, key=lambda row: (row[0], row[1])):
+            self.report(
+                "Ambiguous actor name: {} ({}) matches actors {}, "
+                "pass one of the ids instead.".format(
+                    name, date_of_birth,
+                    ", ".join(str(row[2]) for row in matches)))
+        if unresolved:
+            self.report("Skipped {} cast rows with an unknown movie or an "
+                        "unknown or ambiguous actor".format(unresolved))
+        self.report("Imported {} rows in {:.1f}s ({:.0f} rows/s)".format(
+            staged, elapsed, staged / elapsed if elapsed else staged))
+
+        return results
+
+    @staticmethod
+    def enqueue_purges(connection, last_ids):
+        """adds the tasks purging the shared caches of the imported records"""
+        keys = ["actors", "movies"]
+        for table, entity in ENTITIES.items():
+            purged = connection.execute(
+                text(PURGED_IDS.format(column=entity + "_id", table=table)),
+                last_id=last_ids[table])
+            keys.extend("{}-{}".format(entity, entity_id)
+                        for entity_id, in purged)
+
+        connection.execute(OutboxTask.__table__.insert(), [{
+            "name": "purge_keys",
+            "payload": json.dumps({"keys": batch})
+        } for batch in batches(keys, PURGE_BATCH_SIZE)])
+
+    def create_staging_tables(self, connection):
+        for table, columns in STAGING_TABLES.items():
+            connection.execute("DROP TABLE IF EXISTS {}".format(table))
+            connection.execute("CREATE TEMPORARY TABLE {} ({})".format(
+                table, ", ".join("{} {}".format(name, column_type)
+                                 for name, column_type in columns)))
+
+    def stage(self, connection, table, rows):
+        started = time.time()
+        staged = 0
+        cursor = connection.connection.cursor()
+
+        for batch in batches(rows):
+            if self.is_postgres:
+                self.copy(cursor, table, batch)
+            else:
+                cursor.executemany(
+                    "INSERT INTO {} VALUES ({})".format(
+                        table, ", ".join("?" * len(batch[0]))),
+                    batch)
+
+            staged += len(batch)
+            elapsed = time.time() - started
+            self.report("{}: {} rows staged ({:.0f} rows/s)".format(
+                table, staged, staged / elapsed if elapsed else staged))
+
+        return staged
+
+    @staticmethod
+    def copy(cursor, table, batch):
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(batch)
+        buffer.seek(0)
+        cursor.copy_expert(
+            "COPY {} FROM STDIN WITH (FORMAT csv)".format(table), buffer)
@@ -1,18 +1,32 @@
-from sqlalchemy import Column, String, Integer, ForeignKey, Float, Date
+from sqlalchemy import Column, String, Integer, ForeignKey, Float, Date, \
+    DateTime, Index, Text, inspect
+from sqlalchemy.orm import load_only, selectinload
 from flask_sqlalchemy import SQLAlchemy
+from datetime import datetime
+import json
 import os
 
+from database.changes import changes
+from database.name_index import actor_names
+from database.outbox import task_queue
+
 # database_name = "capstone"
 # database_path = "postgres://{}:{}@{}/{}".format(
 #     'postgres', 'root', 'localhost:5432', database_name)
-database_path = os.environ['DATABASE_URL']
+database_path = os.environ.get('DATABASE_URL')
 
 db = SQLAlchemy()
 
 
 def setup_db(app):
-    """binds a flask application and a SQLAlchemy service"""
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    """
+    binds a flask application and a SQLAlchemy service, to DATABASE_URL
+    unless the application is configured with a database, e.g. in tests
+    """
+    if "SQLALCHEMY_DATABASE_URI" not in app.config:
+        if database_path is None:
+            raise RuntimeError("DATABASE_URL is not set.")
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_path
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
@@ -34,17 +48,210 @@ actor_in_movie = db.Table(
 )
 
 
+def cast_changes(movie):
+    """returns the ids of the actors added to and removed from a cast"""
+    history = inspect(movie).attrs.cast.history
+    return ([actor.id for actor in history.added or ()],
+            [actor.id for actor in history.deleted or ()])
+
+
+class Tombstone(db.Model):
+    """records a deleted movie or actor for delta sync clients"""
+    __tablename__ = "tombstones"
+    __table_args__ = (
+        Index('ix_tombstones_entity_deleted_at', 'entity', 'deleted_at'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    entity = Column(String(32), nullable=False)
+    entity_id = Column(Integer, nullable=False)
+    deleted_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+    def __init__(self, entity, entity_id):
+        self.entity = entity
+        self.entity_id = entity_id
+
+
+class IdempotencyKey(db.Model):
+    """
+    the response of a POST request sent with an Idempotency-Key header,
+    replayed when the same user retries the request with the same key
+    """
+    __tablename__ = "idempotency_keys"
+
+    subject = Column(String(128), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    # null while the first request with the key is being processed
+    status_code = Column(Integer)
+    # when that request claimed the key, another one can take over the key
+    # once the claim expired, e.g. if the worker died
+    claimed_at = Column(DateTime)
+    content_type = Column(String(128))
+    body = Column(Text)
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    def __init__(self, subject, key, request_hash, expires_at):
+        self.subject = subject
+        self.key = key
+        self.request_hash = request_hash
+        self.expires_at = expires_at
+        self.claimed_at = datetime.utcnow()
+
+
+class OutboxTask(db.Model):
+    """
+    a side effect of a write, stored in the transaction of the write so that
+    it is not lost, and run by the task queue once the write is committed
+    """
+    __tablename__ = "outbox"
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String(64), nullable=False)
+    payload = Column(Text, nullable=False)
+    attempts = Column(Integer, nullable=False, default=0)
+    # when the task is due, pushed back while it runs and after a failure
+    available_at = Column(DateTime, nullable=False, index=True,
+                          default=datetime.utcnow)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    failed_at = Column(DateTime)
+    last_error = Column(Text)
+
+    def __init__(self, name, payload):
+        self.name = name
+        self.payload = json.dumps(payload)
+
+
+class ChangeEvent(db.Model):
+    """
+    a change of the catalog, added in the transaction of the change and
+    streamed from GET /changes by every worker
+    """
+    __tablename__ = "change_events"
+    # ids are never reused, even once the events with the highest ids are
+    # pruned, as they are the sequence numbers clients resume from
+    __table_args__ = {"sqlite_autoincrement": True}
+
+    id = Column(Integer, primary_key=True)
+    entity = Column(String(16), nullable=False)
+    action = Column(String(16), nullable=False)
+    data = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, index=True,
+                        default=datetime.utcnow)
+
+    def __init__(self, entity, action, data):
+        self.entity = entity
+        self.action = action
+        self.data = json.dumps(data)
+
+
+class Document(db.Model):
+    """
+    the pre-encoded response of GET /movies/<id> or GET /actors/<id>, null
+    from a change of the movie or actor (or a linked one) until the
+    "changed" task regenerated it
+    """
+    __tablename__ = "documents"
+
+    entity = Column(String(16), primary_key=True)
+    entity_id = Column(Integer, primary_key=True)
+    # bumped by every change, a regenerated body is only stored if there
+    # was no change since the regeneration started
+    generation = Column(Integer, nullable=False, default=0)
+    version = Column(Integer)
+    body = Column(Text)
+
+    def __init__(self, entity, entity_id):
+        self.entity = entity
+        self.entity_id = entity_id
+
+
+def invalidate_documents(entity, entity_ids):
+    if entity_ids:
+        Document.query.filter(Document.entity == entity,
+                              Document.entity_id.in_(entity_ids)) \
+            .update({Document.generation: Document.generation + 1,
+                     Document.body: None}, synchronize_session=False)
+
+
+def record_change(instance, action, related=()):
+    """
+    invalidates the documents of the movie or actor and of the related
+    records whose data includes it, and adds the "changed" (documents) and
+    "purge" (shared caches) tasks for them, in the transaction of the
+    change
+    """
+    entity = type(instance).__name__.lower()
+    related = sorted(set(related))
+
+    if instance.id is None:
+        db.session.flush()
+
+    if action == "insert":
+        db.session.add(Document(entity, instance.id))
+    elif action == "delete":
+        Document.query.filter_by(entity=entity, entity_id=instance.id) \
+            .delete(synchronize_session=False)
+    else:
+        invalidate_documents(entity, [instance.id])
+    invalidate_documents(type(instance).RELATED_ENTITY, related)
+
+    payload = {
+        "entity": entity,
+        "id": instance.id,
+        "action": action,
+        "related": related
+    }
+    for task in ("changed", "purge"):
+        if task_queue.handles(task):
+            db.session.add(OutboxTask(task, payload))
+
+
+def projection_options(model, fields, include=False):
+    """
+    query options that load only the requested columns of a model (and its
+    version) and, if include is set, its relationship in one more query
+    """
+    options = [load_only(*fields, "version")]
+    if include:
+        options.append(selectinload(getattr(model, model.RELATIONSHIP))
+                       .load_only(model.RELATED_FIELD))
+
+    return options
+
+
+def record_cast_changes(movie_id, added, removed):
+    for actor_id in added:
+        changes.record("cast", "insert", {"movie_id": movie_id,
+                                          "actor_id": actor_id})
+    for actor_id in removed:
+        changes.record("cast", "delete", {"movie_id": movie_id,
+                                          "actor_id": actor_id})
+
+
 class Movie(db.Model):
     __tablename__ = "movies"
 
+    FIELDS = ("id", "title", "release_year", "duration", "imdb_rating")
+    SHORT_FIELDS = ("id", "title", "release_year")
+    LONG_FIELDS = ("title", "duration", "release_year", "imdb_rating")
+    RELATIONSHIP = "cast"
+    RELATED_FIELD = "name"
+    RELATED_ENTITY = "actor"
+
     id = Column(Integer, primary_key=True)
     title = Column(String(256), nullable=False)
     release_year = Column(Integer, nullable=False)
     duration = Column(Integer, nullable=False)
     imdb_rating = Column(Float, nullable=False)
+    updated_at = Column(DateTime, nullable=False, index=True,
+                        default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = Column(Integer, nullable=False, server_default='1')
     cast = db.relationship('Actor', secondary=actor_in_movie,
                            backref=db.backref('movies', lazy=True))
 
+    __mapper_args__ = {"version_id_col": version}
+
     def __init__(self, title, release_year, duration, imdb_rating):
         self.title = title
         self.release_year = release_year
@@ -53,13 +260,30 @@ class Movie(db.Model):
 
     def insert(self):
         db.session.add(self)
+        added, removed = cast_changes(self)
+        record_change(self, "insert", added)
+        changes.record("movie", "insert", {"id": self.id})
+        record_cast_changes(self.id, added, removed)
         db.session.commit()
 
     def delete(self):
+        movie_id = self.id
+        cast = [actor.id for actor in self.cast]
+        record_change(self, "delete", cast)
         db.session.delete(self)
+        db.session.add(Tombstone("movie", movie_id))
+        record_cast_changes(movie_id, [], cast)
+        changes.record("movie", "delete", {"id": movie_id})
         db.session.commit()
 
     def update(self):
+        added, removed = cast_changes(self)
+        if added or removed:
+            self.updated_at = datetime.utcnow()
+        record_change(self, "update",
+                      [actor.id for actor in self.cast] + removed)
+        changes.record("movie", "update", {"id": self.id})
+        record_cast_changes(self.id, added, removed)
         db.session.commit()
 
     def short(self):
@@ -86,6 +310,13 @@ class Movie(db.Model):
             "cast": [actor.name for actor in self.cast]
         }
 
+    def project(self, fields, include=False):
+        data = {field: getattr(self, field) for field in fields}
+        if include:
+            data["cast"] = [actor.name for actor in self.cast]
+
+        return data
+
     def __repr__(self):
         return "<Movie {} {} {} {} />".format(self.title, self.release_year,
                                               self.imdb_rating, self.duration)
@@ -94,10 +325,22 @@ class Movie(db.Model):
 class Actor(db.Model):
     __tablename__ = "actors"
 
+    FIELDS = ("id", "name", "full_name", "date_of_birth")
+    SHORT_FIELDS = ("id", "name")
+    LONG_FIELDS = ("name", "full_name", "date_of_birth")
+    RELATIONSHIP = "movies"
+    RELATED_FIELD = "title"
+    RELATED_ENTITY = "movie"
+
     id = Column(Integer, primary_key=True)
     name = Column(String(256), nullable=False)
     full_name = Column(String(512), nullable=False, default='')
     date_of_birth = Column(Date, nullable=False)
+    updated_at = Column(DateTime, nullable=False, index=True,
+                        default=datetime.utcnow, onupdate=datetime.utcnow)
+    version = Column(Integer, nullable=False, server_default='1')
+
+    __mapper_args__ = {"version_id_col": version}
 
     def __init__(self, name, full_name, date_of_birth):
         self.name = name
@@ -105,15 +348,36 @@ class Actor(db.Model):
         self.date_of_birth = date_of_birth
 
     def insert(self):
+        name = self.name
         db.session.add(self)
+        record_change(self, "insert")
+        changes.record("actor", "insert", {"id": self.id})
         db.session.commit()
+        actor_names.add(self.id, name)
 
     def delete(self):
+        actor_id, name = self.id, self.name
+        movies = [movie.id for movie in self.movies]
+        record_change(self, "delete", movies)
         db.session.delete(self)
+        db.session.add(Tombstone("actor", actor_id))
+        for movie_id in movies:
+            changes.record("cast", "delete", {"movie_id": movie_id,
+                                              "actor_id": actor_id})
+        changes.record("actor", "delete", {"id": actor_id})
         db.session.commit()
+        actor_names.remove(actor_id, name)
 
     def update(self):
+        actor_id = self.id
+        history = inspect(self).attrs.name.history
+        record_change(self, "update", [movie.id for movie in self.movies])
+        changes.record("actor", "update", {"id": actor_id})
         db.session.commit()
+        for name in history.deleted or ():
+            actor_names.remove(actor_id, name)
+        for name in history.added or ():
+            actor_names.add(actor_id, name)
 
     def short(self):
         return {
@@ -136,6 +400,15 @@ class Actor(db.Model):
             "movies": [movie.title for movie in self.movies]
         }
 
+    def project(self, fields, include=False):
+        data = {field: getattr(self, field) for field in fields}
+        if "date_of_birth" in data:
+            data["date_of_birth"] = self.date_of_birth.strftime("%B %d, %Y")
+        if include:
+            data["movies"] = [movie.title for movie in self.movies]
+
+        return data
+
     def __repr__(self):
         return "<Movie {} {} {} />".format(self.name, self.full_name,
                                            self.date_of_birth)
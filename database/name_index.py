@@ -0,0 +1,95 @@
+import threading
+from collections import OrderedDict
+
+# maximum number of distinct names kept, least recently used are evicted
+MAX_NAMES = 100000
+
+
+def normalize(name):
+    return name.strip().lower()
+
+
+class ActorNameIndex:
+    """
+    Bounded in-process map from normalized actor name to actor ids.
+    It is warm-loaded at startup and kept up to date by the Actor write
+    methods. A name that is not found may have been evicted or inserted
+    by another worker, so callers fall back to the database on a miss.
+    The ids of a name that is found may miss namesakes added by another
+    worker or an import, so callers confirm hits against the database.
+    """
+
+    def __init__(self, max_names=MAX_NAMES):
+        self.max_names = max_names
+        self._names = OrderedDict()
+        self._lock = threading.Lock()
+        # true while every actor name is indexed, i.e. nothing was evicted
+        self.complete = False
+
+    def __len__(self):
+        return len(self._names)
+
+    def load(self, actors):
+        """replaces the index with (id, name) pairs"""
+        names = OrderedDict()
+        complete = True
+        for actor_id, name in actors:
+            names.setdefault(normalize(name), set()).add(actor_id)
+            if len(names) > self.max_names:
+                names.popitem(last=False)
+                complete = False
+
+        with self._lock:
+            self._names = names
+            self.complete = complete
+
+    def lookup(self, name):
+        """returns the ids of the actors with name, or None on a miss"""
+        key = normalize(name)
+        with self._lock:
+            actor_ids = self._names.get(key)
+            if not actor_ids:
+                return None
+
+            self._names.move_to_end(key)
+            return set(actor_ids)
+
+    def set(self, name, actor_ids):
+        """records the complete set of ids of the actors named name"""
+        key = normalize(name)
+        with self._lock:
+            self._names[key] = set(actor_ids)
+            self._evict(key)
+
+    def add(self, actor_id, name):
+        key = normalize(name)
+        with self._lock:
+            if key in self._names:
+                self._names[key].add(actor_id)
+            elif self.complete:
+                self._names[key] = {actor_id}
+            else:
+                # other actors with this name may exist but are not indexed
+                return
+
+            self._evict(key)
+
+    def _evict(self, key):
+        self._names.move_to_end(key)
+        if len(self._names) > self.max_names:
+            self._names.popitem(last=False)
+            self.complete = False
+
+    def remove(self, actor_id, name):
+        key = normalize(name)
+        with self._lock:
+            actor_ids = self._names.get(key)
+            if actor_ids is not None:
+                actor_ids.discard(actor_id)
+
+    def discard(self, name):
+        with self._lock:
+            self._names.pop(normalize(name), None)
+
+
+actor_names = ActorNameIndex()
@@ -0,0 +1,259 @@
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import Session
+
+logger = logging.getLogger("tasks")
+
+# threads running tasks in each process, 0 leaves them to `manage.py tasks`
+TASK_WORKERS = int(os.environ.get("TASK_WORKERS", 2))
+
+# task ids waiting for a worker, further ones are left in the outbox and
+# picked up by the next sweep
+TASK_QUEUE_SIZE = 1000
+
+# seconds between sweeps of the outbox for tasks that are due, e.g. retries
+# or tasks of a worker that died
+TASK_POLL_INTERVAL = 5
+
+# seconds a worker has to run a task before it is given to another one
+TASK_LEASE = 60
+
+TASK_MAX_ATTEMPTS = 5
+
+# seconds before the first retry of a failed task, doubled for each attempt
+TASK_RETRY_DELAY = 5
+
+
+class TaskWorkers:
+    """
+    The worker threads of one app, which run the tasks committed through it
+    in its app context, and so against its database.
+    """
+
+    def __init__(self, tasks, app):
+        self.tasks = tasks
+        self.app = app
+        self.queue = queue.Queue(TASK_QUEUE_SIZE)
+        self.processed = 0
+        self.retried = 0
+        self.gave_up = 0
+        self.deferred = 0
+        self._threads = []
+        self._stopping = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return bool(self._threads)
+
+    def start(self, workers=None):
+        if self._threads:
+            return
+
+        if workers is None:
+            workers = self.app.config["TASK_WORKERS"]
+        self._stopping.clear()
+        targets = [self.work] * workers + [self.sweep]
+        for target in targets:
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def stats(self):
+        return {
+            "workers": max(len(self._threads) - 1, 0),
+            "queued": self.queue.qsize(),
+            "processed": self.processed,
+            "retried": self.retried,
+            "deferred": self.deferred,
+            "gave_up": self.gave_up
+        }
+
+    def count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def submit(self, task_ids):
+        """hands tasks to the workers without ever blocking the caller"""
+        for task_id in task_ids:
+            try:
+                self.queue.put_nowait(task_id)
+            except queue.Full:
+                self.count("deferred")
+
+    def work(self):
+        while not self._stopping.is_set():
+            try:
+                task_id = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            with self.app.app_context():
+                try:
+                    self.tasks.process(task_id)
+                except SQLAlchemyError:
+                    logger.exception("Could not run task %s", task_id)
+                finally:
+                    self.tasks.db.session.remove()
+
+    def sweep(self):
+        while not self._stopping.wait(TASK_POLL_INTERVAL):
+            free = self.queue.maxsize - self.queue.qsize()
+            if free <= 0:
+                continue
+
+            with self.app.app_context():
+                try:
+                    self.submit(self.tasks.due(free))
+                except SQLAlchemyError:
+                    logger.exception("Could not sweep the outbox")
+                finally:
+                    self.tasks.db.session.remove()
+
+
+class TaskQueue:
+    """
+    Runs the side effects of writes on a pool of worker threads once the
+    write is committed. Tasks are stored in the outbox table in the same
+    transaction as the write and only deleted once they ran, so a task is
+    run at least once even if a worker dies, and handlers must be safe to
+    run again. Each app has its own workers, started by the first request
+    it serves, so that creating an app (e.g. in manage.py) starts none.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+        self.db = None
+        self.model = None
+
+    def handler(self, name):
+        """registers a function called with the payload of each name task"""
+        def decorator(f):
+            self.handlers.setdefault(name, []).append(f)
+            return f
+
+        return decorator
+
+    def handles(self, name):
+        return bool(self.handlers.get(name))
+
+    def init_app(self, app):
+        # imported here as the models enqueue their tasks through this module
+        from database.models import db, OutboxTask
+
+        self.db = db
+        self.model = OutboxTask
+        app.config.setdefault("TASK_WORKERS", TASK_WORKERS)
+
+        if not event.contains(Session, "after_flush", self.after_flush):
+            event.listen(Session, "after_flush", self.after_flush)
+            event.listen(Session, "after_commit", self.after_commit)
+            event.listen(Session, "after_soft_rollback", self.after_rollback)
+
+        workers = app.extensions["task_queue"] = TaskWorkers(self, app)
+        if app.config["TASK_WORKERS"]:
+            app.before_first_request(workers.start)
+
+    @staticmethod
+    def workers(app=None):
+        """the workers of the app, by default of the current one"""
+        app = app or current_app._get_current_object()
+        return app.extensions["task_queue"]
+
+    def after_flush(self, session, flush_context):
+        for instance in session.new:
+            if isinstance(instance, self.model):
+                session.info.setdefault("outbox", []).append(instance.id)
+
+    def after_commit(self, session):
+        task_ids = session.info.pop("outbox", None)
+        # the workers of the app the session belongs to, so that the tasks
+        # run against the database they were committed to
+        app = getattr(session, "app", None)
+        workers = app and app.extensions.get("task_queue")
+        if task_ids and workers is not None and workers.running:
+            workers.submit(task_ids)
+
+    @staticmethod
+    def after_rollback(session, previous_transaction):
+        session.info.pop("outbox", None)
+
+    def due(self, limit=TASK_QUEUE_SIZE):
+        model = self.model
+        return [task_id for task_id, in self.db.session.query(model.id)
+                .filter(model.failed_at.is_(None),
+                        model.available_at <= datetime.utcnow())
+                .order_by(model.available_at)
+                .limit(limit)]
+
+    def run_pending(self):
+        """runs the tasks that are due on the calling thread"""
+        return sum(1 for task_id in self.due() if self.process(task_id))
+
+    def process(self, task_id):
+        """runs a task unless another worker got it, returns if it ran"""
+        model, session = self.model, self.db.session
+        now = datetime.utcnow()
+
+        claimed = model.query.filter(model.id == task_id,
+                                     model.failed_at.is_(None),
+                                     model.available_at <= now) \
+            .update({model.available_at: now + timedelta(seconds=TASK_LEASE),
+                     model.attempts: model.attempts + 1},
+                    synchronize_session=False)
+        session.commit()
+        if not claimed:
+            return False
+
+        task = model.query.get(task_id)
+        try:
+            for handler in self.handlers.get(task.name, ()):
+                handler(**json.loads(task.payload))
+        except Exception as error:
+            session.rollback()
+            task = model.query.get(task_id)
+            task.last_error = repr(error)
+            gave_up = task.attempts >= TASK_MAX_ATTEMPTS
+            if gave_up:
+                task.failed_at = datetime.utcnow()
+                logger.error("Task %s %s failed: %r", task.id, task.name,
+                             error)
+            else:
+                task.available_at = datetime.utcnow() + timedelta(
+                    seconds=TASK_RETRY_DELAY * 2 ** (task.attempts - 1))
+                logger.warning("Task %s %s will be retried: %r", task.id,
+                               task.name, error)
+            session.commit()
+
+            self.workers().count("gave_up" if gave_up else "retried")
+            return False
+
+        session.delete(task)
+        session.commit()
+        self.workers().count("processed")
+
+        return True
+
+    def stats(self):
+        model = self.model
+        return dict(
+            self.workers().stats(),
+            pending=model.query.filter(model.failed_at.is_(None)).count(),
+            failed=model.query.filter(model.failed_at.isnot(None)).count())
+
+
+task_queue = TaskQueue()
@@ -0,0 +1,212 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+
+from flask import current_app, has_app_context, has_request_context, \
+    request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import Pool
+
+logger = logging.getLogger("slow_queries")
+
+# statements slower than this (in milliseconds) are logged with their plan
+SLOW_QUERY_THRESHOLD = int(os.environ.get("SLOW_QUERY_THRESHOLD", 200))
+
+# default statement timeout in milliseconds, 0 disables it
+STATEMENT_TIMEOUT = int(os.environ.get("STATEMENT_TIMEOUT", 0))
+
+# latencies kept per statement fingerprint to compute percentiles
+LATENCY_SAMPLES = 1000
+
+# a plan is captured at most once per fingerprint in this many seconds
+EXPLAIN_INTERVAL = 300
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+PARAMETER_LISTS = re.compile(r"\(\s*(?:\?|%\(\w+\)s|%s|:\w+)"
+                             r"(?:\s*,\s*(?:\?|%\(\w+\)s|%s|:\w+))*\s*\)")
+
+
+def fingerprint(statement):
+    """normalizes a statement so that executions with other values match"""
+    statement = LITERALS.sub("?", " ".join(statement.split()))
+    return PARAMETER_LISTS.sub("(...)", statement)
+
+
+def percentile(samples, fraction):
+    return samples[min(len(samples) - 1, int(len(samples) * fraction))]
+
+
+class StatementStats:
+    def __init__(self, statement):
+        self.statement = statement
+        self.count = 0
+        self.total = 0.0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.slow_count = 0
+        self.plan = None
+        self.explained_at = 0
+
+    def to_dict(self):
+        latencies = sorted(self.latencies)
+        return {
+            "statement": self.statement,
+            "count": self.count,
+            "total_ms": round(self.total, 3),
+            "p50_ms": round(percentile(latencies, 0.5), 3),
+            "p95_ms": round(percentile(latencies, 0.95), 3),
+            "p99_ms": round(percentile(latencies, 0.99), 3),
+            "max_ms": round(latencies[-1], 3),
+            "slow_count": self.slow_count,
+            "plan": self.plan
+        }
+
+
+class QueryLog:
+    """
+    Records execution counts and latencies per statement fingerprint from
+    SQLAlchemy engine events, captures the plan of slow SELECT statements
+    and applies per-route statement timeouts.
+    """
+
+    def __init__(self):
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def install(self, app):
+        app.config.setdefault("SLOW_QUERY_THRESHOLD", SLOW_QUERY_THRESHOLD)
+        app.config.setdefault("STATEMENT_TIMEOUT", STATEMENT_TIMEOUT)
+        # endpoint name -> statement timeout in milliseconds
+        app.config.setdefault("STATEMENT_TIMEOUTS", {})
+
+        if not event.contains(Engine, "before_cursor_execute",
+                              self.before_cursor_execute):
+            event.listen(Engine, "before_cursor_execute",
+                         self.before_cursor_execute)
+            event.listen(Engine, "after_cursor_execute",
+                         self.after_cursor_execute)
+            event.listen(Engine, "handle_error", self.handle_error)
+            event.listen(Engine, "commit", self.end_transaction)
+            event.listen(Engine, "rollback", self.end_transaction)
+            event.listen(Pool, "reset", self.reset_connection)
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def stats(self):
+        with self._lock:
+            stats = [stats.to_dict() for stats in self._stats.values()]
+
+        return sorted(stats, key=lambda stats: stats["total_ms"],
+                      reverse=True)
+
+    def before_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        self.apply_timeout(conn, cursor)
+
+        conn.info.setdefault("query_start", []).append(time.time())
+
+    def after_cursor_execute(self, conn, cursor, statement, parameters,
+                             context, executemany):
+        elapsed = (time.time() - conn.info["query_start"].pop()) * 1000
+        key = fingerprint(statement)
+
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = StatementStats(key)
+            stats.count += 1
+            stats.total += elapsed
+            stats.latencies.append(elapsed)
+
+        threshold = SLOW_QUERY_THRESHOLD
+        if has_app_context():
+            threshold = current_app.config.get("SLOW_QUERY_THRESHOLD",
+                                               threshold)
+        if elapsed < threshold:
+            return
+
+        stats.slow_count += 1
+        if not executemany and statement.lstrip()[:6].upper() == "SELECT" \
+                and time.time() - stats.explained_at > EXPLAIN_INTERVAL:
+            stats.explained_at = time.time()
+            stats.plan = self.explain(conn, statement, parameters)
+
+        logger.warning("Slow query (%.1f ms): %s\n%s", elapsed, key,
+                       stats.plan or "")
+
+    def handle_error(self, context):
+        start = context.connection.info.get("query_start")
+        if start:
+            start.pop()
+
+    @staticmethod
+    def end_transaction(conn):
+        # SET LOCAL only lasts until the end of the transaction
+        conn.info.pop("statement_timeout", None)
+
+    @staticmethod
+    def reset_connection(dbapi_connection, connection_record):
+        connection_record.info.pop("statement_timeout", None)
+
+    @staticmethod
+    def explain(conn, statement, parameters):
+        """
+        runs EXPLAIN (ANALYZE) on PostgreSQL or EXPLAIN QUERY PLAN on SQLite
+        on the raw DBAPI cursor, so that it doesn't fire engine events
+        """
+        cursor = conn.connection.cursor()
+        dialect = conn.dialect.name
+
+        try:
+            if dialect == "postgresql":
+                cursor.execute("SAVEPOINT explain_slow_query")
+                try:
+                    cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement,
+                                   parameters)
+                    plan = [row[0] for row in cursor.fetchall()]
+                finally:
+                    cursor.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+            elif dialect == "sqlite":
+                cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+                plan = [row[-1] for row in cursor.fetchall()]
+            else:
+                return None
+        except Exception as error:
+            return "Could not explain statement: {}".format(error)
+        finally:
+            cursor.close()
+
+        return "\n".join(plan)
+
+    @staticmethod
+    def apply_timeout(conn, cursor):
+        timeout = STATEMENT_TIMEOUT
+        if has_app_context():
+            timeout = current_app.config.get("STATEMENT_TIMEOUT", timeout)
+        if has_request_context():
+            timeout = current_app.config.get("STATEMENT_TIMEOUTS", {}) \
+                .get(request.endpoint, timeout)
+
+        dialect = conn.dialect.name
+        if dialect == "postgresql":
+            # only sent once per transaction, or when the route changes it
+            if conn.info.get("statement_timeout", 0) != timeout:
+                cursor.execute("SET LOCAL statement_timeout = %s",
+                               (timeout,))
+                conn.info["statement_timeout"] = timeout
+        elif dialect == "sqlite":
+            connection = conn.connection.connection
+            if timeout:
+                deadline = time.time() + timeout / 1000.0
+                connection.set_progress_handler(
+                    lambda: time.time() > deadline, 1000)
+            else:
+                connection.set_progress_handler(None, 0)
+
+
+query_log = QueryLog()
@@ -0,0 +1,173 @@
+import json
+import os
+import shutil
+import tempfile
+from datetime import datetime
+
+from sqlalchemy import Date, DateTime, Float, Integer, String, select
+
+from database.models import Actor, Movie, actor_in_movie
+
+# rows fetched from the database and written per record batch
+SNAPSHOT_BATCH_SIZE = 50000
+
+SNAPSHOT_FORMATS = {"arrow": ".arrow", "parquet": ".parquet"}
+
+SNAPSHOT_TABLES = (Movie.__table__, Actor.__table__, actor_in_movie)
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def arrow_type(column_type):
+    import pyarrow as pa
+
+    if isinstance(column_type, Integer):
+        return pa.int64()
+    if isinstance(column_type, Float):
+        return pa.float64()
+    if isinstance(column_type, DateTime):
+        return pa.timestamp("us")
+    if isinstance(column_type, Date):
+        return pa.date32()
+    if isinstance(column_type, String):
+        return pa.string()
+
+    raise SnapshotError("Unsupported column type: {}".format(column_type))
+
+
+class TableWriter:
+    """writes record batches of one table to an Arrow IPC or Parquet file"""
+
+    def __init__(self, path, schema, snapshot_format):
+        import pyarrow as pa
+
+        self.sink = None
+        if snapshot_format == "parquet":
+            import pyarrow.parquet as pq
+            self.writer = pq.ParquetWriter(path, schema)
+        else:
+            # uncompressed IPC files can be memory-mapped and read
+            # without copying, see read_snapshot_table
+            self.sink = pa.OSFile(path, "wb")
+            self.writer = pa.ipc.new_file(self.sink, schema)
+
+    def write(self, batch):
+        import pyarrow as pa
+
+        if self.sink is None:
+            self.writer.write_table(pa.Table.from_batches([batch]))
+        else:
+            self.writer.write_batch(batch)
+
+    def close(self):
+        self.writer.close()
+        if self.sink is not None:
+            self.sink.close()
+
+
+def write_snapshot(engine, directory, snapshot_format="arrow",
+                   batch_size=SNAPSHOT_BATCH_SIZE):
+    """
+    writes a consistent point-in-time copy of the movies, actors and
+    actor_in_movie tables, one file per table plus a manifest, into a new
+    directory inside directory and returns the manifest
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise SnapshotError("pyarrow is required to write snapshots.")
+
+    if snapshot_format not in SNAPSHOT_FORMATS:
+        raise SnapshotError("format must be one of {}.".format(
+            ", ".join(SNAPSHOT_FORMATS)))
+
+    taken_at = datetime.utcnow()
+    name = taken_at.strftime("%Y%m%dT%H%M%S%fZ")
+    os.makedirs(directory, exist_ok=True)
+    staging = tempfile.mkdtemp(prefix=".{}-".format(name), dir=directory)
+    manifest = {
+        "name": name,
+        "taken_at": taken_at.isoformat() + "Z",
+        "format": snapshot_format,
+        "tables": {}
+    }
+
+    try:
+        with engine.connect() as connection:
+            read_only = begin_snapshot(connection)
+
+            for table in SNAPSHOT_TABLES:
+                schema = pa.schema([
+                    pa.field(column.name, arrow_type(column.type),
+                             nullable=column.nullable)
+                    for column in table.columns])
+                file_name = table.name + SNAPSHOT_FORMATS[snapshot_format]
+                writer = TableWriter(os.path.join(staging, file_name),
+                                     schema, snapshot_format)
+                rows = 0
+
+                try:
+                    result = connection.execution_options(
+                        stream_results=True).execute(
+                        select(table.columns).order_by(
+                            *table.primary_key.columns))
+                    while True:
+                        batch = result.fetchmany(batch_size)
+                        if not batch:
+                            break
+
+                        writer.write(pa.RecordBatch.from_arrays([
+                            pa.array([row[index] for row in batch],
+                                     type=field.type)
+                            for index, field in enumerate(schema)
+                        ], schema=schema))
+                        rows += len(batch)
+                finally:
+                    writer.close()
+
+                manifest["tables"][table.name] = {
+                    "file": file_name,
+                    "rows": rows
+                }
+
+            read_only.rollback()
+
+        with open(os.path.join(staging, "manifest.json"), "w") as output:
+            json.dump(manifest, output, indent=2)
+
+        os.rename(staging, os.path.join(directory, name))
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    return manifest
+
+
+def begin_snapshot(connection):
+    """
+    starts the transaction all tables are read in, REPEATABLE READ on
+    PostgreSQL so that every table is read from the same snapshot
+    """
+    if connection.dialect.name == "postgresql":
+        connection.execution_options(isolation_level="REPEATABLE READ")
+        transaction = connection.begin()
+        connection.execute("SET TRANSACTION READ ONLY")
+        return transaction
+
+    transaction = connection.begin()
+    if connection.dialect.name == "sqlite":
+        # pysqlite only opens a transaction before writes, without it every
+        # SELECT would see the database as of the time it started
+        connection.connection.cursor().execute("BEGIN")
+
+    return transaction
+
+
+def read_snapshot_table(path):
+    """memory-maps an Arrow IPC snapshot file and returns it as a Table"""
+    import pyarrow as pa
+
+    # the returned table keeps the mapping open through its buffers
+    return pa.ipc.open_file(pa.memory_map(path, "r")).read_all()
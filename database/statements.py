@@ -0,0 +1,80 @@
+from sqlalchemy import bindparam, text
+from sqlalchemy.ext import baked
+
+from database.models import db, projection_options
+
+# query shapes (model, columns, relationship, filter) kept compiled, the
+# least recently used one is dropped beyond that
+BAKERY_SIZE = 200
+
+bakery = baked.bakery(size=BAKERY_SIZE)
+
+# statements of the hottest reads that PostgreSQL parses and plans once per
+# connection, as server-side prepared statements, instead of once per call
+PREPARED_STATEMENTS = {
+    "fetch_document": "SELECT body, version FROM documents "
+                      "WHERE entity = $1 AND entity_id = $2 "
+                      "AND body IS NOT NULL"
+}
+
+
+def projected(model, fields=None, include=False):
+    """
+    the baked query of a model, loading only the requested columns (and its
+    version) if fields are given, and the relationship if include is set
+    """
+    query = bakery(lambda session: session.query(model), model)
+    if fields is not None:
+        fields = tuple(fields)
+        query.add_criteria(
+            lambda q: q.options(*projection_options(model, fields, include)),
+            fields, include)
+
+    return query
+
+
+def load_one(model, entity_id, fields=None, include=False):
+    """returns the record with the id, None if there isn't one"""
+    query = projected(model, fields, include)
+    query += lambda q: q.filter(model.id == bindparam("id"))
+
+    return query(db.session()).params(id=entity_id).one_or_none()
+
+
+def load_many(model, entity_ids, fields=None, include=False):
+    """returns the records with the ids, in no particular order"""
+    query = projected(model, fields, include)
+    # expanded to one parameter per id when executed, so that the compiled
+    # query is shared by lists of any length
+    query += lambda q: q.filter(
+        model.id.in_(bindparam("ids", expanding=True)))
+
+    return query(db.session()).params(ids=list(entity_ids)).all()
+
+
+def load_all(model, fields=None, include=False):
+    """returns all the records ordered by id"""
+    query = projected(model, fields, include)
+    query += lambda q: q.order_by(model.id)
+
+    return query(db.session()).all()
+
+
+def execute_prepared(name, *parameters):
+    """
+    runs one of the PREPARED_STATEMENTS with EXECUTE on the connection of
+    the session, preparing it first if the connection hasn't yet
+    """
+    connection = db.session.connection()
+    # cleared along with the prepared statements when the connection is
+    # replaced
+    prepared = connection.info.setdefault("prepared_statements", set())
+    if name not in prepared:
+        connection.execute(text("PREPARE {} AS {}".format(
+            name, PREPARED_STATEMENTS[name])))
+        prepared.add(name)
+
+    values = {"p{}".format(number): value
+              for number, value in enumerate(parameters)}
+    return connection.execute(text("EXECUTE {}({})".format(
+        name, ", ".join(":" + key for key in values))), values)
@@ -0,0 +1,68 @@
+import base64
+from datetime import datetime, timedelta
+
+from database.models import db, Tombstone
+
+TOKEN_FORMAT = "%Y-%m-%dT%H:%M:%S.%f"
+
+# a new sync token overlaps the previous window by this much so that rows
+# committed by transactions still in flight while syncing are not missed
+SYNC_OVERLAP = timedelta(seconds=5)
+
+# tombstones older than this are pruned, tokens older than this are refused
+TOMBSTONE_RETENTION = timedelta(days=30)
+
+
+def encode_sync_token(timestamp):
+    value = timestamp.strftime(TOKEN_FORMAT).encode()
+    return base64.urlsafe_b64encode(value).decode()
+
+
+def decode_sync_token(token):
+    """returns the timestamp in a sync token, raises ValueError if invalid"""
+    try:
+        value = base64.urlsafe_b64decode(token.encode()).decode()
+    except (TypeError, UnicodeError, base64.binascii.Error):
+        raise ValueError("Invalid sync token.")
+
+    return datetime.strptime(value, TOKEN_FORMAT)
+
+
+def new_sync_token():
+    """
+    token to hand out with a response that reflects all rows up to now,
+    rounded down to whole seconds so that list responses stay identical
+    (and cacheable) for a while
+    """
+    return encode_sync_token(
+        (datetime.utcnow() - SYNC_OVERLAP).replace(microsecond=0))
+
+
+def is_expired(since):
+    return since < datetime.utcnow() - TOMBSTONE_RETENTION
+
+
+def changed_since(model, since, options=()):
+    """rows of model updated after since, served by the updated_at index"""
+    return model.query.options(*options) \
+        .filter(model.updated_at > since) \
+        .order_by(model.id).all()
+
+
+def deleted_since(entity, since):
+    """ids of the entities of a type deleted after since"""
+    tombstones = Tombstone.query.with_entities(Tombstone.entity_id) \
+        .filter(Tombstone.entity == entity, Tombstone.deleted_at > since) \
+        .order_by(Tombstone.entity_id).all()
+
+    return [tombstone.entity_id for tombstone in tombstones]
+
+
+def prune_tombstones():
+    """deletes the tombstones no client can ask for anymore"""
+    cutoff = datetime.utcnow() - TOMBSTONE_RETENTION
+    pruned = Tombstone.query.filter(Tombstone.deleted_at < cutoff) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+    return pruned
@@ -0,0 +1,22 @@
+# gunicorn settings, read by `gunicorn --config gunicorn.conf.py`
+import os
+
+# gevent workers serve each request, including the long-lived GET /changes
+# streams, on a greenlet, so a worker holds up to worker_connections
+# streams instead of one per thread
+worker_class = "gevent"
+worker_connections = 1000
+
+# the app is loaded by each worker after gevent patched the standard
+# library, so that its threads, locks and sockets yield to other greenlets
+preload_app = False
+
+
+def post_fork(server, worker):
+    # psycopg2 talks to PostgreSQL in C, it only yields to other greenlets
+    # while waiting for the database once patched
+    if not os.environ.get("DATABASE_URL", "").startswith("postgres"):
+        return
+
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
@@ -1,13 +1,79 @@
-from flask_script import Manager
+import os
+
+from flask_script import Manager, Command, Option
 from flask_migrate import Migrate, MigrateCommand
 
-from app import app
+from app import create_app
 from database.models import db
+from database.changes import prune_change_events
+from database.sync import prune_tombstones
+from database.importer import CatalogImporter
+from database.snapshot import write_snapshot
+from database.outbox import task_queue
+from database.documents import build_documents
+from middleware.idempotency import prune_idempotency_keys
 
+app = create_app()
 migrate = Migrate(app, db)
 manager = Manager(app)
 
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def prune():
+    """
+    deletes tombstones older than the delta sync retention period, expired
+    idempotency keys and change events older than a day
+    """
+    print("Pruned {} tombstones".format(prune_tombstones()))
+    print("Pruned {} idempotency keys".format(prune_idempotency_keys()))
+    print("Pruned {} change events".format(prune_change_events()))
+
+
+@manager.command
+def tasks():
+    """runs the post-commit tasks that are due, e.g. with TASK_WORKERS=0"""
+    print("Ran {} tasks".format(task_queue.run_pending()))
+
+
+@manager.command
+def documents():
+    """regenerates the detail documents of all movies and actors"""
+    print("Built {} documents".format(build_documents()))
+
+
+class ImportCommand(Command):
+    """loads actors, movies and cast links from CSV or NDJSON files"""
+
+    option_list = (
+        Option('--actors', dest='actors',
+               help='file with name, full_name, date_of_birth'),
+        Option('--movies', dest='movies',
+               help='file with title, release_year, duration, imdb_rating'),
+        Option('--cast', dest='cast',
+               help='file with title, release_year, actor_name'),
+    )
+
+    def run(self, actors, movies, cast):
+        CatalogImporter(db.engine).run(actors, movies, cast)
+
+
+manager.add_command('import', ImportCommand())
+
+
+@manager.option('-o', '--output', dest='output', default='snapshots',
+                help='directory the snapshot is written into')
+@manager.option('-f', '--format', dest='snapshot_format', default='arrow',
+                help='arrow (memory-mappable IPC files) or parquet')
+def snapshot(output, snapshot_format):
+    """writes a point-in-time columnar snapshot of the catalog tables"""
+    manifest = write_snapshot(db.engine, output, snapshot_format)
+    for table, info in manifest["tables"].items():
+        print("{}: {} rows".format(table, info["rows"]))
+    print("Snapshot written to {}".format(
+        os.path.join(output, manifest["name"])))
+
+
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,143 @@
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import sys
+import time
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+
+from flask import current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# fraction of successful GET requests that are logged, errors and writes
+# are always logged
+ACCESS_LOG_SAMPLE_RATE = float(os.environ.get("ACCESS_LOG_SAMPLE_RATE", 1))
+
+# records waiting for the writer thread, further records are dropped
+ACCESS_LOG_QUEUE_SIZE = 10000
+
+
+class DroppingQueueHandler(QueueHandler):
+    """hands records to the writer thread, dropping them if it falls behind"""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # formatting is left to the writer thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps(dict(
+            time=datetime.utcfromtimestamp(record.created).isoformat() + "Z",
+            **record.msg))
+
+
+class AccessLog:
+    """
+    Logs one JSON record per request, with the route, status, latency, JWT
+    subject, number of SQL statements and cache status. Records are queued
+    and written by a background thread, so requests never wait for I/O.
+    """
+
+    def __init__(self):
+        self.queue = queue.Queue(ACCESS_LOG_QUEUE_SIZE)
+        self.handler = DroppingQueueHandler(self.queue)
+        self.listener = None
+
+        self.logger = logging.getLogger("access")
+        self.logger.setLevel(logging.INFO)
+        self.logger.propagate = False
+        self.logger.addHandler(self.handler)
+        atexit.register(self.stop)
+
+    def init_app(self, app):
+        app.config.setdefault("ACCESS_LOG", True)
+        app.config.setdefault("ACCESS_LOG_SAMPLE_RATE",
+                              ACCESS_LOG_SAMPLE_RATE)
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+
+        if not event.contains(Engine, "after_cursor_execute",
+                              self.count_statement):
+            event.listen(Engine, "after_cursor_execute",
+                         self.count_statement)
+
+        if app.config["ACCESS_LOG"]:
+            self.start()
+
+    def start(self, *handlers):
+        """starts the writer thread, writing to stdout unless given handlers"""
+        if self.listener is not None:
+            return
+
+        if not handlers:
+            stream = logging.StreamHandler(sys.stdout)
+            stream.setFormatter(JSONFormatter())
+            handlers = (stream,)
+
+        self.listener = QueueListener(self.queue, *handlers)
+        self.listener.start()
+
+    def stop(self):
+        """writes the queued records and stops the writer thread"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def stats(self):
+        return {
+            "queued": self.queue.qsize(),
+            "dropped": self.handler.dropped
+        }
+
+    @staticmethod
+    def count_statement(conn, cursor, statement, parameters, context,
+                        executemany):
+        if has_request_context():
+            g.sql_count = g.get("sql_count", 0) + 1
+
+    @staticmethod
+    def before_request():
+        g.request_start = time.perf_counter()
+
+    def after_request(self, response):
+        if not current_app.config["ACCESS_LOG"] or "request_start" not in g:
+            return response
+
+        sample_rate = 1
+        if request.method == "GET" and response.status_code < 400:
+            sample_rate = current_app.config["ACCESS_LOG_SAMPLE_RATE"]
+            if random.random() >= sample_rate:
+                return response
+
+        self.logger.info({
+            "method": request.method,
+            "route": request.url_rule.rule if request.url_rule else None,
+            "path": request.path,
+            "status": response.status_code,
+            "latency_ms": round(
+                (time.perf_counter() - g.request_start) * 1000, 3),
+            "sub": g.get("jwt_sub"),
+            "sql_count": g.get("sql_count", 0),
+            "cache": g.get("cache_status"),
+            "sample_rate": sample_rate
+        })
+
+        return response
+
+
+access_log = AccessLog()
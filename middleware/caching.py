@@ -0,0 +1,148 @@
+import json
+import os
+from functools import wraps
+from urllib.request import Request, urlopen
+
+from flask import current_app, g, request
+
+from database.outbox import task_queue
+
+# Cache-Control of the successful GET responses of each endpoint, responses
+# of other endpoints and errors are not cached. Responses are purged by
+# surrogate key when the records they contain change, so shared caches
+# (s-maxage) can keep them much longer than clients (max-age).
+CACHE_POLICIES = {
+    "get_actors": "public, max-age=0, s-maxage=300",
+    "get_actor_by_id": "public, max-age=0, s-maxage=3600",
+    "get_movies": "public, max-age=0, s-maxage=300",
+    "get_movie_by_id": "public, max-age=0, s-maxage=3600"
+}
+
+# record keys a response is tagged with at most, on top of the list key of
+# its route, so that the Surrogate-Key header stays well below the 16 KB
+# caching proxies accept
+MAX_RECORD_KEYS = 1000
+
+# seconds to wait for the purge endpoint before the task is retried
+PURGE_TIMEOUT = 5
+
+
+class HTTPPurger:
+    """
+    Purges surrogate keys by POSTing them as JSON to an endpoint, e.g.
+    Fastly's batch purge API (with a Fastly-Key header) or a stand-in.
+    """
+
+    def __init__(self, url, headers=None, timeout=PURGE_TIMEOUT):
+        self.url = url
+        self.headers = dict(headers or {}, **{
+            "Content-Type": "application/json"
+        })
+        self.timeout = timeout
+
+    def purge(self, keys):
+        purge_request = Request(
+            self.url, data=json.dumps({"surrogate_keys": keys}).encode(),
+            headers=self.headers, method="POST")
+        with urlopen(purge_request, timeout=self.timeout) as response:
+            response.read()
+
+
+class CachePolicy:
+    """
+    Sets the Cache-Control header of each response from the policy of its
+    endpoint. Cached responses vary by Authorization, as what they contain
+    depends on the permissions of the token.
+    """
+
+    def init_app(self, app):
+        app.config.setdefault("CACHE_POLICIES", CACHE_POLICIES)
+        # any object with a purge(keys) method, or None to not purge
+        app.config.setdefault("PURGER", None)
+        if app.config["PURGER"] is None and os.environ.get("PURGE_URL"):
+            app.config["PURGER"] = HTTPPurger(os.environ["PURGE_URL"])
+
+        app.after_request(self.after_request)
+
+    @staticmethod
+    def after_request(response):
+        if "Cache-Control" in response.headers:
+            return response
+
+        policy = current_app.config["CACHE_POLICIES"].get(request.endpoint)
+        if policy is None or request.method not in ("GET", "HEAD") \
+                or response.status_code not in (200, 304):
+            response.headers["Cache-Control"] = "no-store"
+            return response
+
+        response.headers["Cache-Control"] = policy
+        response.vary.add("Authorization")
+        return response
+
+
+cache_policy = CachePolicy()
+
+
+def surrogate_keys(*templates):
+    """
+    tags the responses of a read route with a Surrogate-Key header, from
+    templates formatted with the arguments of the route and the keys of the
+    records the route added with tag_records
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            response = current_app.make_response(f(*args, **kwargs))
+            keys = [template.format(**kwargs) for template in templates]
+            record_keys = g.pop("surrogate_keys", ())
+            if not g.pop("surrogate_keys_capped", False):
+                keys.extend(record_keys)
+            response.headers["Surrogate-Key"] = " ".join(keys)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def tag_records(entity, entity_ids):
+    """
+    adds the keys of the records of a multi-get or sync response, so that
+    the purge of a record also purges the responses that contain it. Full
+    lists are not tagged, their size is only bounded by the catalog.
+    """
+    keys = g.setdefault("surrogate_keys", [])
+    if len(keys) + len(entity_ids) > MAX_RECORD_KEYS:
+        # the response is still purged with the list key of its route,
+        # which every write purges
+        g.surrogate_keys_capped = True
+        return
+
+    keys.extend("{}-{}".format(entity, entity_id) for entity_id in entity_ids)
+
+
+def changed_keys(entity, entity_id, related_entity, related):
+    """the surrogate keys of the responses a change makes outdated"""
+    keys = {"movies", "actors", "{}-{}".format(entity, entity_id)}
+    keys.update("{}-{}".format(related_entity, related_id)
+                for related_id in related)
+
+    return sorted(keys)
+
+
+# a task of its own, so that an unreachable purge endpoint doesn't hold
+# back the refresh of the documents by the "changed" task
+@task_queue.handler("purge")
+def purge_changed(entity, id, action, related):
+    purger = current_app.config.get("PURGER")
+    if purger is not None:
+        related_entity = "actor" if entity == "movie" else "movie"
+        purger.purge(changed_keys(entity, id, related_entity, related))
+
+
+@task_queue.handler("purge_keys")
+def purge_keys(keys):
+    """purges surrogate keys, e.g. those of the records of an import"""
+    purger = current_app.config.get("PURGER")
+    if purger is not None:
+        purger.purge(keys)
@@ -0,0 +1,140 @@
+import threading
+import time
+from functools import wraps
+
+from flask import current_app, g, request
+
+# seconds a finished result keeps being served to identical requests
+COALESCING_GRACE = 0.1
+
+# finished calls are pruned once more than this many keys are tracked
+MAX_TRACKED_CALLS = 1024
+
+
+class Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.finished_at = None
+
+
+class SingleFlight:
+    """
+    Runs one computation per key at a time. Callers asking for a key that
+    is in flight, or finished less than a grace period ago, wait for and
+    share its result instead of computing it again.
+    """
+
+    def __init__(self):
+        self.computed = 0
+        self.coalesced = 0
+        self.grace_hits = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        app.config.setdefault("COALESCING_GRACE", COALESCING_GRACE)
+        app.after_request(self.after_request)
+
+    def after_request(self, response):
+        # a successful write makes the results shared so far outdated
+        if request.method not in ("GET", "HEAD", "OPTIONS") \
+                and response.status_code < 400:
+            self.forget()
+
+        return response
+
+    def stats(self):
+        with self._lock:
+            in_flight = sum(1 for call in self._calls.values()
+                            if call.finished_at is None)
+
+        return {
+            "computed": self.computed,
+            "coalesced": self.coalesced,
+            "grace_hits": self.grace_hits,
+            "in_flight": in_flight
+        }
+
+    def forget(self):
+        """drops the finished results, e.g. after a write"""
+        with self._lock:
+            self._calls = {key: call for key, call in self._calls.items()
+                           if call.finished_at is None}
+
+    def do(self, key, compute, grace=COALESCING_GRACE):
+        """returns the result of compute and how it was obtained"""
+        now = time.time()
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None and call.finished_at is not None \
+                    and now - call.finished_at > grace:
+                call = None
+
+            if call is None:
+                leader = True
+                call = self._calls[key] = Call()
+                self.computed += 1
+                if len(self._calls) > MAX_TRACKED_CALLS:
+                    self.prune(now, grace)
+            else:
+                leader = False
+                if call.finished_at is None:
+                    self.coalesced += 1
+                    status = "coalesced"
+                else:
+                    self.grace_hits += 1
+                    status = "grace"
+
+        if leader:
+            try:
+                call.result = compute()
+            except Exception as error:
+                call.error = error
+            finally:
+                call.finished_at = time.time()
+                call.done.set()
+            status = "miss"
+        else:
+            call.done.wait()
+
+        if call.error is not None:
+            raise call.error
+
+        return call.result, status
+
+    def prune(self, now, grace):
+        for key in [key for key, call in self._calls.items()
+                    if call.finished_at is not None
+                    and now - call.finished_at > grace]:
+            del self._calls[key]
+
+
+single_flight = SingleFlight()
+
+
+def coalesce(f):
+    """
+    shares the response of a read route between identical concurrent
+    requests: same endpoint, arguments, query string and permissions
+    """
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = (request.endpoint,
+               tuple(sorted(request.view_args.items())),
+               tuple(sorted(request.args.items(multi=True))),
+               frozenset(payload.get("permissions", ())))
+
+        def compute():
+            response = current_app.make_response(f(payload, *args, **kwargs))
+            return (response.get_data(), response.status_code,
+                    [header for header in response.headers
+                     if header[0] != "Content-Length"])
+
+        (body, status_code, headers), g.cache_status = single_flight.do(
+            key, compute, current_app.config["COALESCING_GRACE"])
+
+        return current_app.response_class(body, status_code, headers)
+
+    return wrapper
@@ -0,0 +1,146 @@
+import gzip
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+
+from flask import current_app, request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# responses smaller than this (in bytes) are sent uncompressed
+COMPRESSION_MIN_SIZE = 1024
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+# total size in bytes of the compressed bodies kept for cacheable responses
+COMPRESSION_CACHE_SIZE = 32 * 1024 * 1024
+
+
+def compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+
+    return gzip.compress(data, GZIP_LEVEL)
+
+
+def compress_stream(chunks, encoding):
+    """
+    compresses a streamed body chunk by chunk, flushing after each one
+    so that events reach the client as soon as they are produced
+    """
+    try:
+        if encoding == "br":
+            compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                yield compressor.process(chunk) + compressor.flush()
+            yield compressor.finish()
+        else:
+            compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+            for chunk in chunks:
+                if isinstance(chunk, str):
+                    chunk = chunk.encode()
+                yield compressor.compress(chunk) + \
+                    compressor.flush(zlib.Z_SYNC_FLUSH)
+            yield compressor.flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+class CompressedBodyCache:
+    """LRU cache of compressed bodies keyed by body digest and encoding"""
+
+    def __init__(self, max_size=COMPRESSION_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._bodies = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, data, encoding):
+        key = (hashlib.blake2b(data, digest_size=16).digest(), encoding)
+        with self._lock:
+            body = self._bodies.get(key)
+            if body is not None:
+                self._bodies.move_to_end(key)
+                self.hits += 1
+                return body
+
+            self.misses += 1
+
+        body = compress(data, encoding)
+        with self._lock:
+            if key not in self._bodies and len(body) <= self.max_size:
+                self._bodies[key] = body
+                self.size += len(body)
+                while self.size > self.max_size:
+                    _, evicted = self._bodies.popitem(last=False)
+                    self.size -= len(evicted)
+
+        return body
+
+
+class Compression:
+    """
+    Compresses responses with gzip or brotli, as negotiated from the
+    Accept-Encoding header of the request. Bodies of cacheable responses
+    are compressed once and then served from a cache.
+    """
+
+    def __init__(self, app=None):
+        self.cache = CompressedBodyCache()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        app.config.setdefault("COMPRESSION_MIN_SIZE", COMPRESSION_MIN_SIZE)
+        app.after_request(self.after_request)
+
+    @staticmethod
+    def negotiate():
+        encodings = ["br", "gzip"] if brotli is not None else ["gzip"]
+        return request.accept_encodings.best_match(encodings)
+
+    @staticmethod
+    def is_cacheable(response):
+        cache_control = response.headers.get("Cache-Control", "")
+        return request.method == "GET" and response.status_code == 200 \
+            and "no-store" not in cache_control
+
+    def after_request(self, response):
+        if response.status_code < 200 or response.status_code in (204, 304) \
+                or response.direct_passthrough \
+                or "Content-Encoding" in response.headers:
+            return response
+
+        response.vary.add("Accept-Encoding")
+        encoding = self.negotiate()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding)
+            response.headers.pop("Content-Length", None)
+        else:
+            data = response.get_data()
+            if len(data) < current_app.config["COMPRESSION_MIN_SIZE"]:
+                return response
+
+            if self.is_cacheable(response):
+                response.set_data(self.cache.get(data, encoding))
+            else:
+                response.set_data(compress(data, encoding))
+
+        response.headers["Content-Encoding"] = encoding
+        return response
+
+
+compression = Compression()
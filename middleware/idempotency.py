@@ -0,0 +1,153 @@
+import hashlib
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import abort, current_app, request
+from sqlalchemy.exc import IntegrityError
+
+from database.models import db, IdempotencyKey
+
+# how long (in seconds) a stored response is replayed for retries
+IDEMPOTENCY_KEY_TTL = 24 * 60 * 60
+
+# seconds a request has to complete before a retry with its key can run,
+# longer than the worker timeout so that a claim only expires if it's dead
+IDEMPOTENCY_CLAIM_LEASE = 60
+
+MAX_KEY_LENGTH = 255
+
+
+def request_hash():
+    """identifies the request a key was first used with"""
+    digest = hashlib.sha256()
+    digest.update("{} {}\n".format(request.method, request.path).encode())
+    digest.update(request.get_data())
+
+    return digest.hexdigest()
+
+
+def claim(subject, key, fingerprint):
+    """
+    returns the stored response for the key, or None once the key is
+    claimed for this request, aborting if another request holds it
+    """
+    stored = IdempotencyKey.query.get((subject, key))
+    if stored is not None and stored.expires_at <= datetime.utcnow():
+        db.session.delete(stored)
+        db.session.commit()
+        stored = None
+
+    if stored is None:
+        ttl = current_app.config.get("IDEMPOTENCY_KEY_TTL",
+                                     IDEMPOTENCY_KEY_TTL)
+        db.session.add(IdempotencyKey(
+            subject, key, fingerprint,
+            datetime.utcnow() + timedelta(seconds=ttl)))
+        try:
+            db.session.commit()
+            return None
+        except IntegrityError:
+            # an identical retry claimed the key in the meantime
+            db.session.rollback()
+            stored = IdempotencyKey.query.get((subject, key))
+
+    if stored is not None and stored.status_code is None \
+            and claim_expired(stored) and take_over(stored, fingerprint):
+        return None
+
+    if stored is None or stored.status_code is None:
+        abort(409, "A request with this Idempotency-Key is in progress.")
+
+    if stored.request_hash != fingerprint:
+        abort(422, "The Idempotency-Key was used with another request.")
+
+    return stored
+
+
+def claim_expired(stored):
+    lease = current_app.config.get("IDEMPOTENCY_CLAIM_LEASE",
+                                   IDEMPOTENCY_CLAIM_LEASE)
+    return stored.claimed_at is None or \
+        stored.claimed_at + timedelta(seconds=lease) <= datetime.utcnow()
+
+
+def take_over(stored, fingerprint):
+    """
+    claims a key whose request never completed, returns False if another
+    retry took it over first
+    """
+    taken = IdempotencyKey.query \
+        .filter_by(subject=stored.subject, key=stored.key, status_code=None,
+                   claimed_at=stored.claimed_at) \
+        .update({IdempotencyKey.request_hash: fingerprint,
+                 IdempotencyKey.claimed_at: datetime.utcnow()},
+                synchronize_session=False)
+    db.session.commit()
+
+    return bool(taken)
+
+
+def release(subject, key):
+    """lets the request be retried with the key, e.g. after it failed"""
+    db.session.rollback()
+    IdempotencyKey.query.filter_by(subject=subject, key=key) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+
+def prune_idempotency_keys():
+    """deletes the stored responses that are no longer replayed"""
+    pruned = IdempotencyKey.query \
+        .filter(IdempotencyKey.expires_at < datetime.utcnow()) \
+        .delete(synchronize_session=False)
+    db.session.commit()
+
+    return pruned
+
+
+def idempotent(f):
+    """
+    Replays the stored response of a POST route when the same user sends
+    a request again with the same Idempotency-Key header, without running
+    the route. Errors are not stored, so that the request can be retried.
+    """
+    @wraps(f)
+    def wrapper(payload, *args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return f(payload, *args, **kwargs)
+
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(400, "Idempotency-Key must be 1 to {} characters long."
+                  .format(MAX_KEY_LENGTH))
+
+        subject = payload.get("sub", "")
+        stored = claim(subject, key, request_hash())
+        if stored is not None:
+            response = current_app.response_class(
+                stored.body, stored.status_code,
+                content_type=stored.content_type)
+            response.headers["Idempotent-Replayed"] = "true"
+            return response
+
+        try:
+            response = current_app.make_response(
+                f(payload, *args, **kwargs))
+        except Exception:
+            # aborted requests, e.g. invalid ones, wrote nothing
+            release(subject, key)
+            raise
+
+        if response.status_code >= 500:
+            release(subject, key)
+            return response
+
+        stored = IdempotencyKey.query.get((subject, key))
+        stored.status_code = response.status_code
+        stored.content_type = response.content_type
+        stored.body = response.get_data(as_text=True)
+        db.session.commit()
+
+        return response
+
+    return wrapper
@@ -0,0 +1,50 @@
+"""add updated_at columns and tombstones for delta sync
+
+Revision ID: 3b1d6a9e2c47
+Revises: 0f87e8f45ce0
+Create Date: 2026-10-19 10:12:31.402118
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '3b1d6a9e2c47'
+down_revision = '0f87e8f45ce0'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # the existing rows are stamped with the time of the migration in UTC,
+    # as sync tokens are (now() is the local time of the server session),
+    # the model sets updated_at itself for the new rows
+    migrated_at = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S')
+    for table in ('movies', 'actors'):
+        op.add_column(table,
+                      sa.Column('updated_at', sa.DateTime(), nullable=False,
+                                server_default=migrated_at))
+        with op.batch_alter_table(table) as batch_op:
+            batch_op.alter_column('updated_at', server_default=None)
+        op.create_index(op.f('ix_{}_updated_at'.format(table)), table,
+                        ['updated_at'], unique=False)
+    op.create_table('tombstones',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('entity', sa.String(length=32), nullable=False),
+                    sa.Column('entity_id', sa.Integer(), nullable=False),
+                    sa.Column('deleted_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index('ix_tombstones_entity_deleted_at', 'tombstones',
+                    ['entity', 'deleted_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_tombstones_entity_deleted_at', table_name='tombstones')
+    op.drop_table('tombstones')
+    op.drop_index(op.f('ix_actors_updated_at'), table_name='actors')
+    op.drop_column('actors', 'updated_at')
+    op.drop_index(op.f('ix_movies_updated_at'), table_name='movies')
+    op.drop_column('movies', 'updated_at')
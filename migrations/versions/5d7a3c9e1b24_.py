@@ -0,0 +1,39 @@
+"""add idempotency keys for POST requests
+
+Revision ID: 5d7a3c9e1b24
+Revises: 8c2e4f1a9d53
+Create Date: 2026-10-19 12:21:05.740192
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '5d7a3c9e1b24'
+down_revision = '8c2e4f1a9d53'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('idempotency_keys',
+                    sa.Column('subject', sa.String(length=128),
+                              nullable=False),
+                    sa.Column('key', sa.String(length=255), nullable=False),
+                    sa.Column('request_hash', sa.String(length=64),
+                              nullable=False),
+                    sa.Column('status_code', sa.Integer(), nullable=True),
+                    sa.Column('content_type', sa.String(length=128),
+                              nullable=True),
+                    sa.Column('body', sa.Text(), nullable=True),
+                    sa.Column('expires_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('subject', 'key')
+                    )
+    op.create_index(op.f('ix_idempotency_keys_expires_at'),
+                    'idempotency_keys', ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_idempotency_keys_expires_at'),
+                  table_name='idempotency_keys')
+    op.drop_table('idempotency_keys')
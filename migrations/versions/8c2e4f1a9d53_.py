@@ -0,0 +1,29 @@
+"""add version columns for optimistic concurrency
+
+Revision ID: 8c2e4f1a9d53
+Revises: 3b1d6a9e2c47
+Create Date: 2026-10-19 11:02:47.118305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = '8c2e4f1a9d53'
+down_revision = '3b1d6a9e2c47'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('movies',
+                  sa.Column('version', sa.Integer(), nullable=False,
+                            server_default='1'))
+    op.add_column('actors',
+                  sa.Column('version', sa.Integer(), nullable=False,
+                            server_default='1'))
+
+
+def downgrade():
+    op.drop_column('actors', 'version')
+    op.drop_column('movies', 'version')
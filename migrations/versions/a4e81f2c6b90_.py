@@ -0,0 +1,36 @@
+"""add outbox for post-commit tasks
+
+Revision ID: a4e81f2c6b90
+Revises: 5d7a3c9e1b24
+Create Date: 2026-10-19 13:37:48.261549
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'a4e81f2c6b90'
+down_revision = '5d7a3c9e1b24'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('outbox',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('name', sa.String(length=64), nullable=False),
+                    sa.Column('payload', sa.Text(), nullable=False),
+                    sa.Column('attempts', sa.Integer(), nullable=False),
+                    sa.Column('available_at', sa.DateTime(), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.Column('failed_at', sa.DateTime(), nullable=True),
+                    sa.Column('last_error', sa.Text(), nullable=True),
+                    sa.PrimaryKeyConstraint('id')
+                    )
+    op.create_index(op.f('ix_outbox_available_at'), 'outbox',
+                    ['available_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_outbox_available_at'), table_name='outbox')
+    op.drop_table('outbox')
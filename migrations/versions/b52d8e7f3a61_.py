@@ -0,0 +1,37 @@
+"""add change events streamed by every worker
+
+Revision ID: b52d8e7f3a61
+Revises: e6f3a9d2c815
+Create Date: 2026-10-19 17:26:09.384152
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'b52d8e7f3a61'
+down_revision = 'e6f3a9d2c815'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('change_events',
+                    sa.Column('id', sa.Integer(), nullable=False),
+                    sa.Column('entity', sa.String(length=16),
+                              nullable=False),
+                    sa.Column('action', sa.String(length=16),
+                              nullable=False),
+                    sa.Column('data', sa.Text(), nullable=False),
+                    sa.Column('created_at', sa.DateTime(), nullable=False),
+                    sa.PrimaryKeyConstraint('id'),
+                    sqlite_autoincrement=True
+                    )
+    op.create_index(op.f('ix_change_events_created_at'), 'change_events',
+                    ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_change_events_created_at'),
+                  table_name='change_events')
+    op.drop_table('change_events')
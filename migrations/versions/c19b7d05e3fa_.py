@@ -0,0 +1,37 @@
+"""add precomputed detail documents
+
+Revision ID: c19b7d05e3fa
+Revises: a4e81f2c6b90
+Create Date: 2026-10-19 14:52:16.903377
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'c19b7d05e3fa'
+down_revision = 'a4e81f2c6b90'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('documents',
+                    sa.Column('entity', sa.String(length=16),
+                              nullable=False),
+                    sa.Column('entity_id', sa.Integer(), nullable=False),
+                    sa.Column('generation', sa.Integer(), nullable=False),
+                    sa.Column('version', sa.Integer(), nullable=True),
+                    sa.Column('body', sa.Text(), nullable=True),
+                    sa.PrimaryKeyConstraint('entity', 'entity_id')
+                    )
+    # empty documents, so that changes can invalidate them until
+    # `manage.py documents` builds them
+    op.execute("INSERT INTO documents (entity, entity_id, generation) "
+               "SELECT 'movie', id, 0 FROM movies")
+    op.execute("INSERT INTO documents (entity, entity_id, generation) "
+               "SELECT 'actor', id, 0 FROM actors")
+
+
+def downgrade():
+    op.drop_table('documents')
@@ -0,0 +1,25 @@
+"""add a lease to in-progress idempotency keys
+
+Revision ID: e6f3a9d2c815
+Revises: c19b7d05e3fa
+Create Date: 2026-10-19 16:04:37.518230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+# revision identifiers, used by Alembic.
+revision = 'e6f3a9d2c815'
+down_revision = 'c19b7d05e3fa'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # null for the keys claimed before, which can be taken over right away
+    op.add_column('idempotency_keys',
+                  sa.Column('claimed_at', sa.DateTime(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('idempotency_keys', 'claimed_at')
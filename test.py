@@ -1,21 +1,125 @@
+import gzip
+import logging.handlers
 import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
 import unittest
 import json
+from unittest import mock
+from datetime import date, datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.sql.compiler import SQLCompiler
 
 from app import create_app
-from database.models import setup_db, Actor, Movie
+from auth.testing import install_local_keys, make_token, USER_PERMISSIONS, \
+    MANAGER_PERMISSIONS, ADMIN_PERMISSIONS
+from database.models import setup_db, db, Actor, Movie, OutboxTask, \
+    IdempotencyKey, Document
+from database.changes import changes, PostgresListener
+from database.query_log import query_log
+from database.importer import CatalogImporter
+from database.snapshot import read_snapshot_table
+from middleware.access_log import access_log
+from database.outbox import task_queue
+from database.documents import build_documents, fetch_document
+from middleware.caching import HTTPPurger
+from middleware.coalescing import SingleFlight, single_flight
+
+
+def seed_database():
+    """adds the records of casting.sql and the ones deleted by the tests"""
+    actors = [
+        Actor('Anne Hathaway', 'Anne Jacqueline Hathaway',
+              date(1982, 11, 12)),
+        Actor('Matthew McConaughey', 'Matthew David McConaughey',
+              date(1969, 11, 4)),
+        Actor('Margot Robbie', 'Margot Elise Robbie', date(1990, 7, 2)),
+        Actor('Mary Elizabeth Winstead', 'Mary Elizabeth Winstead',
+              date(1984, 11, 28)),
+        Actor('Ana de Armas', 'Ana Celia de Armas Caso', date(1988, 4, 30))
+    ]
+    movies = [
+        Movie('Serenity', 2019, 106, 5.3),
+        Movie('Birds of Prey', 2020, 109, 6.2),
+        Movie('Knives Out', 2019, 130, 7.9)
+    ]
+    movies[0].cast = actors[0:2]
+    movies[1].cast = actors[2:4]
+    movies[2].cast = actors[4:]
+
+    db.session.add_all(actors + movies)
+    db.session.commit()
+
+
+class PurgeRecorder(BaseHTTPRequestHandler):
+    """stand-in for the purge API of a caching proxy"""
+    purged = []
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.purged.append(json.loads(body)["surrogate_keys"])
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
 
 
 class CastingAgencyTestCase(unittest.TestCase):
     """This class represents the casting agency test case"""
 
+    @classmethod
+    def setUpClass(cls):
+        """
+        Seeds a template SQLite database once per process (so once per
+        worker with pytest -n), which every test then gets a copy of.
+        """
+        install_local_keys()
+        cls.user_token = make_token(USER_PERMISSIONS)
+        cls.manager_token = make_token(MANAGER_PERMISSIONS)
+        cls.admin_token = make_token(ADMIN_PERMISSIONS)
+        cls.directory = tempfile.mkdtemp(prefix='capstone-test-')
+        cls.template = os.path.join(cls.directory, 'template.db')
+        cls.databases = 0
+
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + cls.template,
+            "ACCESS_LOG": False,
+            "TASK_WORKERS": 0,
+            "CHANGE_FEED": False
+        })
+        with app.app_context():
+            db.create_all()
+            seed_database()
+            db.session.remove()
+
+        # the access log is only written by the test that checks it
+        access_log.stop()
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory, ignore_errors=True)
+
     def setUp(self):
         """Define test variables and initialize app."""
-        self.user_token = os.environ['user_token']
-        self.manager_token = os.environ['manager_token']
-        self.admin_token = os.environ['admin_token']
-        self.app = create_app()
+        type(self).databases += 1
+        self.database = os.path.join(
+            self.directory, 'test-{}.db'.format(self.databases))
+        shutil.copyfile(self.template, self.database)
+        self.app = create_app({
+            "TESTING": True,
+            "ACCESS_LOG": False,
+            "TASK_WORKERS": 0,
+            # the tests read the change events themselves
+            "CHANGE_FEED": False,
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + self.database,
+            # results must not be shared between the databases of two tests
+            "COALESCING_GRACE": 0
+        })
         self.client = self.app.test_client
         setup_db(self.app)
 
@@ -64,7 +168,10 @@ class CastingAgencyTestCase(unittest.TestCase):
 
     def tearDown(self):
         """Executed after reach test"""
-        pass
+        with self.app.app_context():
+            db.session.remove()
+            db.get_engine(self.app).dispose()
+        os.remove(self.database)
 
     def test_health(self):
         """Test for GET / (health endpoint)"""
@@ -75,6 +182,12 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertIn('health', data)
         self.assertEqual(data['health'], 'Running!!')
 
+    def test_create_app_without_database(self):
+        """Test that the app refuses to start without a database"""
+        with mock.patch('database.models.database_path', None):
+            with self.assertRaises(RuntimeError):
+                create_app({"ACCESS_LOG": False, "TASK_WORKERS": 0})
+
     def test_api_call_without_token(self):
         """Failing Test trying to make a call without token"""
         res = self.client().get('/actors')
@@ -84,6 +197,18 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertFalse(data["success"])
         self.assertEqual(data["message"], "Authorization Header is required.")
 
+    def test_api_call_with_expired_token(self):
+        """Failing Test trying to make a call with an expired token"""
+        res = self.client().get('/actors', headers={
+            'Authorization': "Bearer {}".format(
+                make_token(USER_PERMISSIONS, expires_in=-60))
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data["success"])
+        self.assertEqual(data["message"], "Token expired.")
+
     def test_get_actors(self):
         """Passing Test for GET /actors"""
         res = self.client().get('/actors', headers={
@@ -110,6 +235,34 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertIn('full_name', data['actor'])
         self.assertTrue(len(data["actor"]["movies"]))
 
+    def test_get_actors_with_gzip(self):
+        """Passing Test for GET /actors with Accept-Encoding: gzip"""
+        self.app.config["COMPRESSION_MIN_SIZE"] = 0
+        res = self.client().get('/actors', headers={
+            'Authorization': "Bearer {}".format(self.user_token),
+            'Accept-Encoding': 'gzip'
+        })
+        data = json.loads(gzip.decompress(res.data))
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', res.headers['Vary'])
+        self.assertTrue(data["success"])
+        self.assertTrue(len(data["actors"]))
+
+    def test_get_actors_by_ids(self):
+        """Passing Test for GET /actors?ids=<actor_ids>"""
+        res = self.client().get('/actors?ids=2,1,100', headers={
+            'Authorization': "Bearer {}".format(self.user_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        self.assertEqual([actor["id"] for actor in data["actors"]], [2, 1])
+        self.assertIn('movies', data["actors"][0])
+        self.assertEqual(data["not_found"], [100])
+
     def test_404_get_actors_by_id(self):
         """Failing Test for GET /actors/<actor_id>"""
         res = self.client().get('/actors/100', headers={
@@ -143,6 +296,67 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertTrue(data["success"])
         self.assertIn('created_actor_id', data)
 
+    def test_create_actor_with_idempotency_key(self):
+        """Passing Test for POST /actors retried with an Idempotency-Key"""
+        headers = {
+            'Authorization': "Bearer {}".format(self.manager_token),
+            'Idempotency-Key': 'create-ana-de-armas'
+        }
+        res = self.client().post('/actors', headers=headers,
+                                 json=self.VALID_NEW_ACTOR)
+        retry = self.client().post('/actors', headers=headers,
+                                   json=self.VALID_NEW_ACTOR)
+        with self.app.app_context():
+            count = Actor.query.filter_by(name="Ana de Armas").count()
+
+        self.assertEqual(res.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(json.loads(retry.data), json.loads(res.data))
+        self.assertEqual(retry.headers['Idempotent-Replayed'], 'true')
+        self.assertEqual(count, 2)
+
+    def test_409_create_actor_with_claimed_idempotency_key(self):
+        """Failing Test for POST /actors while its key is claimed"""
+        headers = {
+            'Authorization': "Bearer {}".format(self.manager_token),
+            'Idempotency-Key': 'create-ana-de-armas'
+        }
+        # left in progress, as by a worker that died
+        with self.app.app_context():
+            claimed = IdempotencyKey('auth0|local-test-user',
+                                     'create-ana-de-armas', 'unknown',
+                                     datetime.utcnow() + timedelta(days=1))
+            db.session.add(claimed)
+            db.session.commit()
+        res = self.client().post('/actors', headers=headers,
+                                 json=self.VALID_NEW_ACTOR)
+        with self.app.app_context():
+            claimed = IdempotencyKey.query.get(('auth0|local-test-user',
+                                                'create-ana-de-armas'))
+            claimed.claimed_at -= timedelta(minutes=2)
+            db.session.commit()
+        retry = self.client().post('/actors', headers=headers,
+                                   json=self.VALID_NEW_ACTOR)
+
+        self.assertEqual(res.status_code, 409)
+        self.assertEqual(retry.status_code, 201)
+
+    def test_422_create_actor_with_reused_idempotency_key(self):
+        """Failing Test for POST /actors reusing an Idempotency-Key"""
+        headers = {
+            'Authorization': "Bearer {}".format(self.manager_token),
+            'Idempotency-Key': 'create-ana-de-armas'
+        }
+        self.client().post('/actors', headers=headers,
+                           json=self.VALID_NEW_ACTOR)
+        res = self.client().post('/actors', headers=headers,
+                                 json=dict(self.VALID_NEW_ACTOR, name="Ana"))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertIn('message', data)
+
     def test_422_create_actor(self):
         """Failing Test for POST /actors"""
         res = self.client().post('/actors', headers={
@@ -224,6 +438,111 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertIn('movies', data)
         self.assertTrue(len(data["movies"]))
 
+    def test_get_movies_by_ids(self):
+        """Passing Test for GET /movies?ids=<movie_ids>"""
+        res = self.client().get('/movies?ids=1,100', headers={
+            'Authorization': "Bearer {}".format(self.user_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        self.assertEqual([movie["id"] for movie in data["movies"]], [1])
+        self.assertIn('cast', data["movies"][0])
+        self.assertEqual(data["not_found"], [100])
+
+    def test_400_get_movies_by_ids(self):
+        """Failing Test for GET /movies?ids=<movie_ids>"""
+        res = self.client().get('/movies?ids=1,two', headers={
+            'Authorization': "Bearer {}".format(self.user_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+        self.assertIn('message', data)
+
+    def test_get_movies_with_fields_and_cast(self):
+        """Passing Test for GET /movies?fields=<fields>&include=cast"""
+        res = self.client().get('/movies?fields=title&include=cast', headers={
+            'Authorization': "Bearer {}".format(self.user_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        self.assertEqual(set(data["movies"][0]), {'title', 'cast'})
+
+    def test_get_movie_by_id_with_fields(self):
+        """Passing Test for GET /movies/<movie_id>?fields=<fields>"""
+        res = self.client().get(
+            '/movies/1?fields=title,imdb_rating', headers={
+                'Authorization': "Bearer {}".format(self.user_token)
+            })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        self.assertEqual(set(data["movie"]), {'title', 'imdb_rating'})
+
+    def test_400_get_movies_with_fields(self):
+        """Failing Test for GET /movies?fields=<fields>"""
+        res = self.client().get('/movies?fields=title,budget', headers={
+            'Authorization': "Bearer {}".format(self.user_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+        self.assertIn('message', data)
+
+    def test_401_get_movies_with_fields(self):
+        """Failing Test for GET /movies?fields=<fields> without movies-info"""
+        headers = {
+            'Authorization': "Bearer {}".format(make_token(['get:movies']))
+        }
+        short = self.client().get('/movies?fields=title', headers=headers)
+        res = self.client().get('/movies?fields=title,duration',
+                                headers=headers)
+        included = self.client().get('/movies?include=cast',
+                                     headers=headers)
+        data = json.loads(res.data)
+
+        self.assertEqual(short.status_code, 200)
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data['success'])
+        self.assertEqual(included.status_code, 401)
+
+    def test_get_movies_updated_since(self):
+        """Passing Test for GET /movies?updated_since=<sync_token>"""
+        res = self.client().get('/movies', headers={
+            'Authorization': "Bearer {}".format(self.user_token)
+        })
+        sync_token = json.loads(res.data)["sync_token"]
+
+        res = self.client().get('/movies?updated_since={}'.format(
+            sync_token), headers={
+            'Authorization': "Bearer {}".format(self.user_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        self.assertIn('movies', data)
+        self.assertIn('deleted_movies', data)
+        self.assertIn('sync_token', data)
+
+    def test_400_get_movies_updated_since(self):
+        """Failing Test for GET /movies?updated_since=<sync_token>"""
+        res = self.client().get('/movies?updated_since=invalid', headers={
+            'Authorization': "Bearer {}".format(self.user_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 400)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'Invalid sync token.')
+
     def test_get_movie_by_id(self):
         """Passing Test for GET /movies/<movie_id>"""
         res = self.client().get('/movies/1', headers={
@@ -283,6 +602,65 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertIn('message', data)
 
+    def test_create_movie_with_actor_ids(self):
+        """Passing Test for POST /movies with the cast given as actor ids"""
+        res = self.client().post('/movies', headers={
+            'Authorization': "Bearer {}".format(self.manager_token)
+        }, json=dict(self.VALID_NEW_MOVIE, cast=[1, "Margot Robbie"]))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 201)
+        self.assertTrue(data["success"])
+        self.assertIn('created_movie_id', data)
+
+    def test_422_create_movie_with_unknown_actor(self):
+        """Failing Test for POST /movies with an unknown cast member"""
+        res = self.client().post('/movies', headers={
+            'Authorization': "Bearer {}".format(self.manager_token)
+        }, json=dict(self.VALID_NEW_MOVIE, cast=["Nobody"]))
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'Unknown actor: Nobody.')
+
+    def test_422_create_movie_with_ambiguous_actor(self):
+        """Failing Test for POST /movies with a name of several actors"""
+        headers = {
+            'Authorization': "Bearer {}".format(self.manager_token)
+        }
+        created = self.client().post('/actors', headers=headers, json=dict(
+            self.VALID_NEW_ACTOR, name="Margot Robbie"))
+        res = self.client().post('/movies', headers=headers,
+                                 json=self.VALID_NEW_MOVIE)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(
+            data['message'],
+            'Ambiguous actor name: Margot Robbie matches actors 3, {}, '
+            'pass one of the ids instead.'.format(
+                json.loads(created.data)['created_actor_id']))
+
+    def test_422_create_movie_with_unindexed_namesake(self):
+        """Failing Test for POST /movies with a namesake of another worker"""
+        with self.app.app_context():
+            # as another worker or an import would, without the name index
+            # of this process knowing
+            db.session.execute(Actor.__table__.insert().values(
+                name="Margot Robbie", full_name="Margot Robbie",
+                date_of_birth=date(1970, 1, 1),
+                updated_at=datetime.utcnow()))
+            db.session.commit()
+        res = self.client().post('/movies', headers={
+            'Authorization': "Bearer {}".format(self.manager_token)
+        }, json=self.VALID_NEW_MOVIE)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertIn('Ambiguous actor name: Margot Robbie', data['message'])
+
     def test_update_movie_info(self):
         """Passing Test for PATCH /movies/<movie_id>"""
         res = self.client().patch('/movies/1', headers={
@@ -296,6 +674,35 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertEqual(data["movie_info"]["imdb_rating"],
                          self.VALID_UPDATE_MOVIE["imdb_rating"])
 
+    def test_update_movie_info_with_etag(self):
+        """Passing Test for PATCH /movies/<movie_id> with If-Match"""
+        res = self.client().get('/movies/1', headers={
+            'Authorization': "Bearer {}".format(self.manager_token)
+        })
+        etag = res.headers['ETag']
+
+        res = self.client().patch('/movies/1', headers={
+            'Authorization': "Bearer {}".format(self.manager_token),
+            'If-Match': etag
+        }, json=self.VALID_UPDATE_MOVIE)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        self.assertIn('ETag', res.headers)
+
+    def test_412_update_movie_info(self):
+        """Failing Test for PATCH /movies/<movie_id> with a stale If-Match"""
+        res = self.client().patch('/movies/1', headers={
+            'Authorization': "Bearer {}".format(self.manager_token),
+            'If-Match': '"0"'
+        }, json=self.VALID_UPDATE_MOVIE)
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 412)
+        self.assertFalse(data['success'])
+        self.assertIn('message', data)
+
     def test_422_update_movie_info(self):
         """Failing Test for PATCH /movies/<movie_id>"""
         res = self.client().patch('/movies/1', headers={
@@ -340,6 +747,589 @@ class CastingAgencyTestCase(unittest.TestCase):
         self.assertFalse(data['success'])
         self.assertIn('message', data)
 
+    def test_get_changes(self):
+        """Passing Test for GET /changes"""
+        with self.app.app_context():
+            broadcaster = changes.broadcaster()
+            last_event_id = broadcaster.sequence
+        self.client().patch('/movies/1', headers={
+            'Authorization': "Bearer {}".format(self.manager_token)
+        }, json=self.VALID_UPDATE_MOVIE)
+        with self.app.app_context():
+            broadcaster.poll()
+
+        res = self.client().get('/changes', headers={
+            'Authorization': "Bearer {}".format(self.user_token),
+            'Last-Event-ID': str(last_event_id)
+        })
+        message = next(iter(res.response)).decode()
+        res.close()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.mimetype, 'text/event-stream')
+        self.assertIn('"entity": "movie"', message)
+        self.assertIn('"action": "update"', message)
+
+    def test_get_changes_of_other_workers(self):
+        """Test for GET /changes streaming a change made by another app"""
+        other = create_app({
+            "ACCESS_LOG": False,
+            "TASK_WORKERS": 0,
+            "CHANGE_FEED": False,
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + self.database
+        })
+        broadcaster = changes.broadcaster(self.app)
+        broadcaster.start()
+        try:
+            with self.app.app_context():
+                last_event_id = broadcaster.sequence
+            other.test_client().delete('/actors/5', headers={
+                'Authorization': "Bearer {}".format(self.admin_token)
+            })
+            events = broadcaster.wait(last_event_id, 5)
+        finally:
+            broadcaster.stop()
+
+        self.assertEqual([(event["entity"], event["action"], event["data"])
+                          for event in events], [
+            ("cast", "delete", {"movie_id": 3, "actor_id": 5}),
+            ("actor", "delete", {"id": 5})
+        ])
+
+    def test_postgres_listener_wait(self):
+        """Test that the change feed listener waits for a notification"""
+        class Notified:
+            def __init__(self, sock):
+                self.sock = sock
+                self.notifies = ["catalog_changes"]
+                self.polled = 0
+
+            def fileno(self):
+                return self.sock.fileno()
+
+            def poll(self):
+                self.polled += 1
+
+        reader, writer = socket.socketpair()
+        try:
+            listener = PostgresListener.__new__(PostgresListener)
+            listener.connection = mock.Mock(connection=Notified(reader))
+            writer.send(b"x")
+            listener.wait(5)
+        finally:
+            reader.close()
+            writer.close()
+
+        self.assertEqual(listener.connection.connection.polled, 1)
+        self.assertEqual(listener.connection.connection.notifies, [])
+
+    def test_reset_get_changes(self):
+        """Passing Test for GET /changes with an unknown Last-Event-ID"""
+        with self.app.app_context():
+            last_event_id = changes.broadcaster().sequence + 1000
+        res = self.client().get('/changes', headers={
+            'Authorization': "Bearer {}".format(self.user_token),
+            'Last-Event-ID': str(last_event_id)
+        })
+        message = next(iter(res.response)).decode()
+        res.close()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('event: reset', message)
+
+    def test_get_query_stats(self):
+        """Passing Test for GET /admin/queries"""
+        self.app.config["SLOW_QUERY_THRESHOLD"] = 0
+        self.client().get('/movies/1', headers={
+            'Authorization': "Bearer {}".format(self.user_token)
+        })
+
+        res = self.client().get('/admin/queries', headers={
+            'Authorization': "Bearer {}".format(self.admin_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        self.assertTrue(len(data["queries"]))
+        self.assertTrue(any(query["plan"] for query in data["queries"]))
+
+    def test_get_query_stats_with_manager_token(self):
+        """Failing Test for GET /admin/queries"""
+        res = self.client().get('/admin/queries', headers={
+            'Authorization': "Bearer {}".format(self.manager_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 401)
+        self.assertFalse(data["success"])
+        self.assertIn('message', data)
+
+    def test_get_stats(self):
+        """Passing Test for GET /admin/stats"""
+        for _ in range(2):
+            self.client().get('/movies', headers={
+                'Authorization': "Bearer {}".format(self.user_token)
+            })
+
+        res = self.client().get('/admin/stats', headers={
+            'Authorization': "Bearer {}".format(self.admin_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertTrue(data["success"])
+        self.assertIn('coalescing', data)
+        self.assertTrue(data["coalescing"]["computed"])
+
+    def test_coalesced_calls(self):
+        """Test that concurrent identical calls share one computation"""
+        flight = SingleFlight()
+        release = threading.Event()
+        computed = []
+        results = []
+
+        def compute():
+            computed.append(1)
+            release.wait(5)
+            return "movies"
+
+        def call():
+            results.append(flight.do("movies", compute))
+
+        threads = [threading.Thread(target=call) for _ in range(4)]
+        threads[0].start()
+        while not flight.stats()["in_flight"]:
+            time.sleep(0.001)
+        for thread in threads[1:]:
+            thread.start()
+        while flight.stats()["coalesced"] < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(computed), 1)
+        self.assertEqual(sorted(results), [("movies", "coalesced")] * 3 + [
+            ("movies", "miss")])
+        self.assertEqual(flight.stats(), {
+            "computed": 1, "coalesced": 3, "grace_hits": 0, "in_flight": 0
+        })
+
+    def test_coalescing_grace(self):
+        """Test for the results shared during the grace period"""
+        flight = SingleFlight()
+        computed = []
+
+        def compute():
+            computed.append(1)
+            return len(computed)
+
+        first = flight.do("movies", compute, grace=60)
+        second = flight.do("movies", compute, grace=60)
+        flight.forget()
+        third = flight.do("movies", compute, grace=60)
+
+        self.assertEqual([first, second, third],
+                         [(1, "miss"), (1, "grace"), (2, "miss")])
+        self.assertEqual(flight.stats()["grace_hits"], 1)
+        self.assertEqual(flight.stats()["computed"], 2)
+
+    def test_coalescing_forgotten_after_write(self):
+        """Test that a write drops the responses shared by GET /movies"""
+        self.app.config["COALESCING_GRACE"] = 60
+        # results of the earlier tests, on their own databases
+        single_flight.forget()
+        headers = {
+            'Authorization': "Bearer {}".format(self.manager_token)
+        }
+        before = self.client().get('/movies?ids=1', headers=headers)
+        self.client().patch('/movies/1', headers=headers,
+                            json=self.VALID_UPDATE_MOVIE)
+        after = self.client().get('/movies?ids=1', headers=headers)
+
+        self.assertNotEqual(json.loads(before.data)["movies"][0]
+                            ["imdb_rating"], 6.5)
+        self.assertEqual(json.loads(after.data)["movies"][0]["imdb_rating"],
+                         6.5)
+
+    def test_create_snapshot(self):
+        """Passing Test for POST /admin/snapshots"""
+        with tempfile.TemporaryDirectory() as directory:
+            self.app.config["SNAPSHOT_DIR"] = directory
+            res = self.client().post('/admin/snapshots', headers={
+                'Authorization': "Bearer {}".format(self.admin_token)
+            })
+            data = json.loads(res.data)
+            snapshot = data["snapshot"]
+            movies = read_snapshot_table(os.path.join(
+                directory, snapshot["name"],
+                snapshot["tables"]["movies"]["file"]))
+
+            self.assertEqual(res.status_code, 201)
+            self.assertTrue(data["success"])
+            self.assertEqual(movies.num_rows,
+                             snapshot["tables"]["movies"]["rows"])
+            self.assertIn('title', movies.column_names)
+
+    def test_422_create_snapshot(self):
+        """Failing Test for POST /admin/snapshots"""
+        res = self.client().post('/admin/snapshots', json={
+            "format": "csv"
+        }, headers={
+            'Authorization': "Bearer {}".format(self.admin_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(res.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertIn('message', data)
+
+    def test_access_log(self):
+        """Test for the access log records of GET /movies/<movie_id>"""
+        records = logging.handlers.BufferingHandler(capacity=100)
+        self.app.config["ACCESS_LOG"] = True
+        self.app.config["ACCESS_LOG_SAMPLE_RATE"] = 0
+        access_log.start(records)
+        try:
+            self.client().get('/movies/1', headers={
+                'Authorization': "Bearer {}".format(self.user_token)
+            })
+            self.client().get('/movies/100', headers={
+                'Authorization': "Bearer {}".format(self.user_token)
+            })
+        finally:
+            access_log.stop()
+        logged = [record.msg for record in records.buffer]
+
+        self.assertEqual(len(logged), 1)
+        self.assertEqual(logged[0]["route"], '/movies/<int:movie_id>')
+        self.assertEqual(logged[0]["status"], 404)
+        self.assertEqual(logged[0]["sub"], 'auth0|local-test-user')
+        self.assertTrue(logged[0]["sql_count"])
+        self.assertIn('cache', logged[0])
+        self.assertIn('latency_ms', logged[0])
+
+    def test_post_commit_tasks(self):
+        """Test for the tasks enqueued by PATCH /actors/<actor_id>"""
+        changes = []
+        with mock.patch.dict(task_queue.handlers, {
+            "changed": [lambda **change: changes.append(change)],
+            "purge": []
+        }):
+            res = self.client().patch('/actors/1', headers={
+                'Authorization': "Bearer {}".format(self.manager_token)
+            }, json=self.VALID_UPDATE_ACTOR)
+            with self.app.app_context():
+                pending = OutboxTask.query.count()
+                ran = task_queue.run_pending()
+                remaining = OutboxTask.query.count()
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual((pending, ran, remaining), (1, 1, 0))
+        self.assertEqual(changes, [{
+            "entity": "actor", "id": 1, "action": "update", "related": [1]
+        }])
+
+    def test_post_commit_task_workers(self):
+        """Test that tasks run on the workers of the app that wrote them"""
+        app = create_app({
+            "TESTING": True,
+            "ACCESS_LOG": False,
+            "TASK_WORKERS": 1,
+            "CHANGE_FEED": False,
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + self.database
+        })
+        workers = task_queue.workers(app)
+        started = workers.running
+        ran = threading.Event()
+        headers = {
+            'Authorization': "Bearer {}".format(self.manager_token)
+        }
+        with mock.patch.dict(task_queue.handlers, {
+            "changed": [lambda **change: ran.set()], "purge": []
+        }), mock.patch('database.outbox.TASK_POLL_INTERVAL', 60):
+            try:
+                app.test_client().patch('/actors/1', headers=headers,
+                                        json=self.VALID_UPDATE_ACTOR)
+                ran.wait(5)
+                # the test app has no workers, its task stays in the outbox
+                self.client().patch('/actors/2', headers=headers,
+                                    json=self.VALID_UPDATE_ACTOR)
+            finally:
+                # also waits for the task of the app to be deleted
+                workers.stop()
+        with self.app.app_context():
+            pending = OutboxTask.query.count()
+
+        self.assertFalse(started)
+        self.assertTrue(ran.is_set())
+        self.assertEqual(pending, 1)
+
+    def test_post_commit_task_retry(self):
+        """Test for a failing post-commit task of DELETE /movies/<movie_id>"""
+        def fail(**change):
+            raise RuntimeError("search index unavailable")
+
+        with mock.patch.dict(task_queue.handlers, {
+            "changed": [fail], "purge": []
+        }):
+            self.client().delete('/movies/3', headers={
+                'Authorization': "Bearer {}".format(self.admin_token)
+            })
+            with self.app.app_context():
+                ran = task_queue.run_pending()
+                task = OutboxTask.query.one()
+
+        res = self.client().get('/admin/tasks', headers={
+            'Authorization': "Bearer {}".format(self.admin_token)
+        })
+        data = json.loads(res.data)
+
+        self.assertEqual(ran, 0)
+        self.assertEqual(task.attempts, 1)
+        self.assertIn('search index unavailable', task.last_error)
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(data["tasks"]["pending"], 1)
+
+    def test_get_movie_document(self):
+        """Test for GET /movies/<movie_id> served from its document"""
+        headers = {
+            'Authorization': "Bearer {}".format(self.user_token)
+        }
+        built = self.client().get('/movies/1', headers=headers)
+        with self.app.app_context():
+            build_documents()
+        res = self.client().get('/movies/1', headers=headers)
+
+        self.client().patch('/actors/1', headers={
+            'Authorization': "Bearer {}".format(self.manager_token)
+        }, json={"name": "Anne J. Hathaway"})
+        stale = self.client().get('/movies/1', headers=headers)
+        with self.app.app_context():
+            task_queue.run_pending()
+            document = fetch_document("movie", 1)
+        refreshed = self.client().get('/movies/1', headers=headers)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(json.loads(res.data), json.loads(built.data))
+        self.assertEqual(res.headers['ETag'], built.headers['ETag'])
+        self.assertIn("Anne J. Hathaway", json.loads(stale.data)["movie"]
+                      ["cast"])
+        self.assertIsNotNone(document)
+        self.assertEqual(refreshed.data, document.body.encode())
+        self.assertEqual(json.loads(refreshed.data), json.loads(stale.data))
+
+    def test_get_movie_cache_headers(self):
+        """Test for the caching headers of GET /movies/<movie_id>"""
+        res = self.client().get('/movies/1', headers={
+            'Authorization': "Bearer {}".format(self.user_token)
+        })
+        created = self.client().post('/movies', headers={
+            'Authorization': "Bearer {}".format(self.manager_token)
+        }, json=self.VALID_NEW_MOVIE)
+
+        self.assertEqual(res.status_code, 200)
+        self.assertIn('s-maxage', res.headers['Cache-Control'])
+        self.assertIn('Authorization', res.headers['Vary'])
+        self.assertEqual(res.headers['Surrogate-Key'], 'movie-1')
+        self.assertEqual(created.headers['Cache-Control'], 'no-store')
+
+    def test_purge_on_update(self):
+        """Test for the purge sent after PATCH /actors/<actor_id>"""
+        server = HTTPServer(('127.0.0.1', 0), PurgeRecorder)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        PurgeRecorder.purged = []
+        self.app.config["PURGER"] = HTTPPurger(
+            "http://127.0.0.1:{}/purge".format(server.server_port))
+        try:
+            self.client().patch('/actors/1', headers={
+                'Authorization': "Bearer {}".format(self.manager_token)
+            }, json=self.VALID_UPDATE_ACTOR)
+            with self.app.app_context():
+                task_queue.run_pending()
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
+
+        self.assertEqual(PurgeRecorder.purged, [
+            ["actor-1", "actors", "movie-1", "movies"]
+        ])
+
+    def test_purge_failure(self):
+        """Test that a failing purge doesn't hold back the documents"""
+        class FailingPurger:
+            def purge(self, keys):
+                raise OSError("purge endpoint unavailable")
+
+        self.app.config["PURGER"] = FailingPurger()
+        with self.app.app_context():
+            build_documents()
+        self.client().patch('/actors/1', headers={
+            'Authorization': "Bearer {}".format(self.manager_token)
+        }, json={"name": "Anne J. Hathaway"})
+        with self.app.app_context():
+            task_queue.run_pending()
+            document = fetch_document("actor", 1)
+            task = OutboxTask.query.one()
+
+        self.assertIn("Anne J. Hathaway", document.body)
+        self.assertEqual(task.name, "purge")
+        self.assertIn("purge endpoint unavailable", task.last_error)
+
+    def test_list_surrogate_keys(self):
+        """Test for the record keys of GET /movies and GET /movies?ids="""
+        headers = {
+            'Authorization': "Bearer {}".format(self.user_token)
+        }
+        listed = self.client().get('/movies', headers=headers)
+        requested = self.client().get('/movies?ids=2,1000', headers=headers)
+        with mock.patch('middleware.caching.MAX_RECORD_KEYS', 1):
+            capped = self.client().get('/movies?ids=1,2', headers=headers)
+
+        self.assertEqual(listed.headers['Surrogate-Key'], "movies")
+        self.assertEqual(requested.headers['Surrogate-Key'],
+                         "movies movie-2 movie-1000")
+        self.assertEqual(capped.headers['Surrogate-Key'], "movies")
+
+    def test_cached_statements(self):
+        """Test that GET /actors?ids=<actor_ids> reuses its compiled query"""
+        headers = {
+            'Authorization': "Bearer {}".format(self.user_token)
+        }
+        self.client().get('/actors?ids=1', headers=headers)
+        query_log.reset()
+        with mock.patch.object(SQLCompiler, '__init__', autospec=True,
+                               side_effect=SQLCompiler.__init__) as compile:
+            res = self.client().get('/actors?ids=3,1,2', headers=headers)
+        data = json.loads(res.data)
+        statements = [query["statement"] for query in query_log.stats()
+                      if "WHERE actors.id IN" in query["statement"]]
+
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual([actor["id"] for actor in data["actors"]],
+                         [3, 1, 2])
+        self.assertEqual(len(statements), 1)
+        self.assertEqual(compile.call_count, 0)
+
+    def test_import_catalog(self):
+        """Passing Test for the manage.py import command"""
+        with tempfile.TemporaryDirectory() as directory:
+            actors = os.path.join(directory, 'actors.csv')
+            with open(actors, 'w') as actors_file:
+                actors_file.write('name,full_name,date_of_birth\n'
+                                  'Import Actor,Import Actor,1990-01-01\n')
+
+            movies = os.path.join(directory, 'movies.ndjson')
+            with open(movies, 'w') as movies_file:
+                movies_file.write(json.dumps({
+                    "title": "Import Movie", "release_year": 2020,
+                    "duration": 100, "imdb_rating": 7
+                }) + '\n')
+
+            cast = os.path.join(directory, 'cast.csv')
+            with open(cast, 'w') as cast_file:
+                cast_file.write('title,release_year,actor_name,'
+                                'date_of_birth\n'
+                                'Import Movie,2020,Import Actor,1990-01-01\n')
+
+            with self.app.app_context():
+                importer = CatalogImporter(self.db.engine, report=len)
+                importer.run(actors, movies, cast)
+                results = importer.run(actors, movies, cast)
+                movie = Movie.query.filter_by(title="Import Movie").one()
+                cast_names = [actor.name for actor in movie.cast]
+                documents = Document.query.filter_by(
+                    entity="movie", entity_id=movie.id).count()
+
+        self.assertEqual(results, {
+            "actors": 0, "movies": 0, "cast links": 0
+        })
+        self.assertEqual(cast_names, ["Import Actor"])
+        self.assertEqual(documents, 1)
+
+    def test_import_actors_without_full_name(self):
+        """Test for actors staged with a NULL full_name, as COPY does"""
+        def copied_rows(path):
+            yield ("Copied Actor", None, date(1990, 1, 1))
+
+        with mock.patch('database.importer.actor_rows', copied_rows):
+            with self.app.app_context():
+                importer = CatalogImporter(self.db.engine, report=len)
+                results = importer.run(actors="actors.csv")
+                actor = Actor.query.filter_by(name="Copied Actor").one()
+
+        self.assertEqual(results["actors"], 1)
+        self.assertEqual(actor.full_name, "")
+
+    def test_import_cast_of_namesakes(self):
+        """Passing Test for cast rows matching several actors"""
+        with self.app.app_context():
+            namesakes = [Actor("Namesake", "Namesake {}".format(number),
+                               date(1990, 1, 1)) for number in range(2)]
+            for actor in namesakes:
+                actor.insert()
+            namesake_ids = [actor.id for actor in namesakes]
+            task_queue.run_pending()
+            movie = Movie.query.get(1)
+            title, release_year = movie.title, movie.release_year
+            version, updated_at = movie.version, movie.updated_at
+            build_documents()
+
+        with tempfile.TemporaryDirectory() as directory:
+            cast = os.path.join(directory, 'cast.ndjson')
+            with open(cast, 'w') as cast_file:
+                for row in ({"actor_name": "Namesake",
+                             "date_of_birth": "1990-01-01"},
+                            {"actor_id": namesake_ids[1]}):
+                    row.update(title=title, release_year=release_year)
+                    cast_file.write(json.dumps(row) + '\n')
+
+            reports = []
+            with self.app.app_context():
+                importer = CatalogImporter(self.db.engine,
+                                           report=reports.append)
+                results = importer.run(cast=cast)
+                movie = Movie.query.get(1)
+                cast_ids = [actor.id for actor in movie.cast]
+                imported = (movie.version, movie.updated_at)
+                stale = [fetch_document("movie", 1),
+                         fetch_document("actor", namesake_ids[1])]
+                unchanged = fetch_document("actor", namesake_ids[0])
+                purged = []
+                self.app.config["PURGER"] = mock.Mock(purge=purged.extend)
+                with mock.patch.dict(task_queue.handlers, {"changed": []}):
+                    task_queue.run_pending()
+
+        self.assertEqual(results["cast links"], 1)
+        self.assertEqual(stale, [None, None])
+        self.assertEqual(sorted(purged), [
+            "actor-{}".format(namesake_ids[1]), "actors", "movie-1",
+            "movies"])
+        self.assertIsNotNone(unchanged)
+        self.assertIn(namesake_ids[1], cast_ids)
+        self.assertNotIn(namesake_ids[0], cast_ids)
+        self.assertIn("Ambiguous actor name: Namesake (1990-01-01) matches "
+                      "actors {}, {}, pass one of the ids instead.".format(
+                          *namesake_ids), reports)
+        self.assertEqual(imported[0], version + 1)
+        self.assertGreater(imported[1], updated_at)
+
+    def test_import_cast_without_date_of_birth(self):
+        """Failing Test for cast rows identifying actors by name only"""
+        with tempfile.TemporaryDirectory() as directory:
+            cast = os.path.join(directory, 'cast.csv')
+            with open(cast, 'w') as cast_file:
+                cast_file.write('title,release_year,actor_name\n'
+                                'Import Movie,2020,Import Actor\n')
+
+            with self.app.app_context():
+                importer = CatalogImporter(self.db.engine, report=len)
+                with self.assertRaises(ValueError):
+                    importer.run(cast=cast)
+
 
 # Make the tests conveniently executable
 if __name__ == "__main__":